@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class SearchengineConfig(AppConfig):
+  name = 'searchengine'
+
+  def ready(self):
+    # Connects the signal handlers that keep derived tables (document frequencies...) in sync
+    import searchengine.signals
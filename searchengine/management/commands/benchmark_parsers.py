@@ -0,0 +1,68 @@
+# encoding=utf8
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from searchengine.utils.scraper.pagecache import get_page_cache
+from searchengine.utils.scraper.sources import SOURCES
+
+
+class Command(BaseCommand):
+  help = 'Times the recipe page parsers on the page cache with and without SoupStrainers, and checks they agree'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--source', dest='source', default=None, choices=[i[0] for i in SOURCES],
+                        help='Only benchmark the parser of one source')
+    parser.add_argument('--max-pages', type=int, dest='max_pages', default=None,
+                        help='Number of cached pages to parse per source')
+    parser.add_argument('--max-mismatches', type=int, dest='max_mismatches', default=20,
+                        help='Number of mismatching pages to print')
+
+  def handle(self, *args, **options):
+    page_cache = get_page_cache()
+    if not page_cache.enabled:
+      raise CommandError(u'The page cache is disabled (settings.PAGE_CACHE_DIR is None)')
+
+    scrapers = dict((domain, scraper()) for domain, scraper in SOURCES
+                    if options['source'] is None or domain == options['source'])
+    pages = dict((domain, []) for domain in scrapers)
+    for page in page_cache:
+      domain = [i for i in scrapers if i in page['url']]
+      if len(domain) > 0 and (options['max_pages'] is None or len(pages[domain[0]]) < options['max_pages']):
+        pages[domain[0]].append(page)
+
+    mismatches = 0
+    for domain in sorted(scrapers):
+      scraper = scrapers[domain]
+      if len(pages[domain]) < 1:
+        continue
+
+      scraper.use_strainers = False
+      full_results, full_time = self.parse_all(scraper, pages[domain])
+      scraper.use_strainers = True
+      strained_results, strained_time = self.parse_all(scraper, pages[domain])
+
+      for page, full, strained in zip(pages[domain], full_results, strained_results):
+        if full != strained:
+          mismatches += 1
+          if mismatches <= options['max_mismatches']:
+            self.stdout.write(u'Mismatch in {0}:\n  {1!r}\n  {2!r}'.format(page['url'], full, strained))
+
+      self.stdout.write(u'{0}: {1} pages, full tree {2:.3f}s, strained {3:.3f}s ({4:.1f}x)'.format(
+        domain, len(pages[domain]), full_time, strained_time, full_time / strained_time if strained_time > 0 else 0.))
+
+    if mismatches > 0:
+      raise CommandError(u'{0} pages were parsed differently'.format(mismatches))
+
+  def parse_all(self, scraper, pages):
+    """
+    :return: tuple (list of the result of parse_recipe, or of the exception it raised, for each page; seconds taken)
+    """
+    results = []
+    start_time = time()
+    for page in pages:
+      try:
+        results.append(scraper.parse_recipe(dict(page['recipe']), page['html']))
+      except Exception as e:
+        results.append(repr(e))
+    return results, time() - start_time
@@ -0,0 +1,110 @@
+# encoding=utf8
+import os
+from time import time
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, DatabaseError
+from django.core.management.base import BaseCommand, CommandError
+
+from searchengine.models import DirectionsIndex, DirectionsFulltextIndex
+from searchengine.utils.search.phrase import DirectionsPhraseIndex, SegmentPhraseIndex
+from searchengine.utils.search.segment import write_segment
+
+# Name of the segment file of each table -> table
+TABLES = (
+  ('directions-fulltext', DirectionsFulltextIndex),
+  ('directions', DirectionsIndex),
+)
+
+
+def megabytes(size):
+  return u'{0:.2f} MB'.format(size / 1e6)
+
+
+class Command(BaseCommand):
+  help = 'Writes DirectionsFulltextIndex and DirectionsIndex to compact segment files, and compares their sizes'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--table', dest='table', default=None, choices=[i[0] for i in TABLES],
+                        help='Only write the segment of one table')
+    parser.add_argument('--output-dir', dest='output_dir',
+                        default=os.path.join(settings.BASE_DIR, 'searchengine/data/segments'),
+                        help='Directory the segment files are written to')
+    parser.add_argument('--verify', action='store_true', dest='verify', default=False,
+                        help='Read every stem back from the segments and check it against the tables')
+
+  def handle(self, *args, **options):
+    output_dir = options['output_dir']
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+
+    for name, model in TABLES:
+      if options['table'] is not None and name != options['table']:
+        continue
+
+      start_time = time()
+      index = DirectionsPhraseIndex(model).build()
+      load_time = time() - start_time
+
+      start_time = time()
+      path = os.path.join(output_dir, name + '.seg')
+      segment_size = write_segment(path, index)
+      write_time = time() - start_time
+
+      positions = len(index.positions)
+      # Every row holds its id, recipe id and position (4 bytes each), and its stem
+      term_positions = np.diff(index.position_offsets[index.term_offsets])
+      column_size = 12 * positions + sum(len(stem.encode('utf-8')) * int(term_positions[term])
+                                         for stem, term in index.terms.items())
+      table_size = self.table_size(model)
+
+      self.stdout.write(u'{0}: {1} positions of {2} stems in {3} recipes ({4} postings), loaded in {5:.1f}s, '
+                        u'written in {6:.1f}s'.format(name, positions, len(index.terms),
+                                                      len(np.unique(index.recipe_ids)), len(index.recipe_ids),
+                                                      load_time, write_time))
+      self.stdout.write(u'  segment {0}: {1} ({2:.2f} bytes per position)'.format(
+        path, megabytes(segment_size), segment_size / float(max(positions, 1))))
+      self.stdout.write(u'  {0}: {1} of column data ({2:.2f}x the segment){3}'.format(
+        model._meta.db_table, megabytes(column_size), column_size / float(segment_size),
+        u', {0} with its indexes ({1:.2f}x the segment)'.format(megabytes(table_size), table_size / float(segment_size))
+        if table_size is not None else u''))
+
+      if options['verify']:
+        self.verify(index, path)
+
+    self.stdout.write(u'Set settings.DIRECTIONS_SEGMENT to the directions-fulltext segment to serve directions '
+                      u'searches from it')
+
+  def table_size(self, model):
+    """
+    :return: int Bytes taken by a table and its indexes, as reported by the database, or None if it can't tell
+    """
+    table = model._meta.db_table
+    try:
+      with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+          cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+        elif connection.vendor == 'sqlite':
+          # Only if SQLite was built with the dbstat virtual table
+          cursor.execute('SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                         '(SELECT name FROM sqlite_master WHERE tbl_name = %s)', [table])
+        else:
+          return None
+        return cursor.fetchone()[0]
+    except DatabaseError:
+      return None
+
+  def verify(self, index, path):
+    segment = SegmentPhraseIndex(path)
+    mismatches = 0
+    for stem, term in index.terms.items():
+      segment_term = segment.term(stem)
+      recipe_ids = index.postings(term)
+      if segment_term is None or not np.array_equal(recipe_ids, segment.postings(segment_term)) or \
+          not np.array_equal(index.term_keys(term, recipe_ids), segment.term_keys(segment_term, recipe_ids)):
+        mismatches += 1
+
+    if len(segment) != len(index.terms) or mismatches > 0:
+      raise CommandError(u'{0} does not match the table ({1} stems differ)'.format(path, mismatches))
+    self.stdout.write(u'  verified {0} stems'.format(len(index.terms)))
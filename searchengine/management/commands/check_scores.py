@@ -0,0 +1,45 @@
+# encoding=utf8
+from django.core.management.base import BaseCommand
+from searchengine.models import Recipe, StemScore
+from searchengine.utils.search.scoring import BATCH_SIZE, rebuild_document_frequencies, stale_stems, stale_recipes, stem_idfs, \
+  recipe_scores, save_values, save_scores
+from searchengine.utils.search.cache import invalidate_search_results
+
+
+class Command(BaseCommand):
+  help = 'Reports the stem idfs and recipe scores that are stale, and optionally refreshes them (e.g. from cron)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--tolerance', type=float, dest='tolerance', default=0.01,
+                        help='Largest idf drift that is still considered fresh')
+    parser.add_argument('--refresh', action='store_true', dest='refresh', default=False,
+                        help='Update the stale idfs and rescore the recipes that depend on them')
+    parser.add_argument('--recount', action='store_true', dest='recount', default=False,
+                        help='Recount the document frequencies from DirectionsIndex first')
+    parser.add_argument('--show', type=int, dest='show', default=20,
+                        help='Number of stale stems to list')
+
+  def handle(self, *args, **options):
+    if options['recount']:
+      rebuild_document_frequencies()
+
+    n = Recipe.objects.all().count()
+    stems = stale_stems(n, options['tolerance'])
+    recipe_ids = stale_recipes(stems)
+
+    self.stdout.write(u'{0}/{1} stem idfs are stale, affecting {2}/{3} recipe scores'.format(
+      len(stems), StemScore.objects.count(), len(recipe_ids), n))
+    drifts = sorted(stems.items(), key=lambda i: abs(i[1][1] - i[1][0]), reverse=True)
+    for stem, (idf, current) in drifts[:options['show']]:
+      self.stdout.write(u'  {0}: {1:.4f} -> {2:.4f}'.format(stem, idf, current))
+
+    if options['refresh'] and (len(stems) > 0 or len(recipe_ids) > 0):
+      save_values(StemScore, 'idf', dict((stem, current) for stem, (idf, current) in stems.items()))
+      idfs = stem_idfs(n)
+      recipe_ids = sorted(recipe_ids)
+      scores = {}
+      for i in range(0, len(recipe_ids), BATCH_SIZE):
+        scores.update(recipe_scores(Recipe.objects.filter(pk__in=recipe_ids[i:i + BATCH_SIZE]), idfs))
+      save_scores(scores)
+      self.stdout.write(u'Refreshed {0} stem idfs and {1} recipe scores'.format(len(stems), len(scores)))
+      invalidate_search_results()
@@ -0,0 +1,47 @@
+# encoding=utf8
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from searchengine.models import Recipe, Ingredient
+from searchengine.utils.text.processor import TextProcessor
+
+
+class Command(BaseCommand):
+  help = 'Checks that TextProcessor.tokenize_text matches its reference implementation over the stored corpus'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--max-mismatches', type=int, dest='max_mismatches', default=20,
+                        help='Number of mismatching documents to print before giving up')
+
+  def handle(self, *args, **options):
+    processor = TextProcessor()
+
+    documents = []
+    for name, description, directions in Recipe.objects.values_list('name', 'description', 'directions').iterator():
+      documents += [i for i in (name, description, directions) if i is not None]
+    for display_name, search_name in Ingredient.objects.values_list('display_name', 'search_name').iterator():
+      documents += [display_name, search_name]
+
+    start_time = time()
+    tokens = [processor.tokenize_text(i) for i in documents]
+    elapsed = time() - start_time
+
+    start_time = time()
+    reference_tokens = [processor.tokenize_text_reference(i) for i in documents]
+    reference_elapsed = time() - start_time
+
+    mismatches = 0
+    for i in range(len(documents)):
+      if tokens[i] != reference_tokens[i]:
+        mismatches += 1
+        if mismatches <= options['max_mismatches']:
+          self.stdout.write(u'Mismatch in {0!r}:\n  {1!r}\n  {2!r}'.format(documents[i], tokens[i],
+                                                                           reference_tokens[i]))
+
+    self.stdout.write(u'{0} documents, {1} tokens, {2} mismatches'.format(len(documents),
+                                                                          sum(len(i) for i in reference_tokens),
+                                                                          mismatches))
+    self.stdout.write(u'tokenize_text: {0:.3f}s, reference: {1:.3f}s'.format(elapsed, reference_elapsed))
+    if mismatches > 0:
+      raise CommandError(u'{0} documents were tokenized differently'.format(mismatches))
@@ -0,0 +1,31 @@
+# encoding=utf8
+from django.core.management.base import BaseCommand
+
+from searchengine.models import Recipe, RecipeFeatures
+from searchengine.utils.search.features import compute_features
+from searchengine.utils.search.cache import invalidate_search_results
+
+
+class Command(BaseCommand):
+  help = 'Precomputes the ranking features of each recipe'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--all', action='store_true', dest='all', default=False,
+                        help='Recompute the features of every recipe, not just the ones that have none yet')
+    parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000)
+
+  def handle(self, *args, **options):
+    batch_size = options['batch_size']
+
+    if options['all']:
+      RecipeFeatures.objects.all().delete()
+
+    recipe_ids = list(Recipe.objects.filter(features__isnull=True).order_by('id').values_list('id', flat=True))
+
+    for i in range(0, len(recipe_ids), batch_size):
+      features = compute_features(Recipe.objects.filter(pk__in=recipe_ids[i:i + batch_size]))
+      RecipeFeatures.objects.bulk_create(features)
+      self.stdout.write(u'Computed features for {0}/{1} recipes'.format(min(i + batch_size, len(recipe_ids)),
+                                                                          len(recipe_ids)))
+
+    invalidate_search_results()
@@ -1,23 +1,44 @@
 # encoding=utf8
+from django.db import transaction
 from django.core.management.base import BaseCommand
 
 from searchengine.models import Ingredient, IngredientIndex
+from searchengine.utils.search.scoring import BATCH_SIZE
+from searchengine.utils.search.cache import invalidate_search_results
 
 
 class Command(BaseCommand):
-  help = ''
+  help = 'Rebuilds the stem index of the ingredient search names'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--full', action='store_true', dest='full', default=False,
+                        help='Delete and rewrite every row instead of only the ones that changed')
 
   def handle(self, *args, **options):
-    ingredients = Ingredient.objects.all().distinct()
+    # Every (ingredient, stem) pair the index should contain, as a set so lookups don't scan a list
+    entries = set()
+    for ingredient_id, search_name in Ingredient.objects.values_list('id', 'search_name').iterator():
+      entries.update((ingredient_id, token) for token in search_name.split())
+
+    # The swap happens in one transaction, so searches keep seeing the old index until the new one is complete
+    stale_ids, existing = [], set()
+    with transaction.atomic():
+      if options['full']:
+        IngredientIndex.objects.all().delete()
+      else:
+        # Keep the rows that are still right (once each), and remember the rest for deletion
+        for pk, ingredient_id, stem in IngredientIndex.objects.values_list('id', 'ingredient_id', 'stem').iterator():
+          if (ingredient_id, stem) in entries and (ingredient_id, stem) not in existing:
+            existing.add((ingredient_id, stem))
+          else:
+            stale_ids.append(pk)
 
-    if IngredientIndex.objects.all().count() > 0:
-      IngredientIndex.objects.all().delete()
+      for i in range(0, len(stale_ids), BATCH_SIZE):
+        IngredientIndex.objects.filter(pk__in=stale_ids[i:i + BATCH_SIZE]).delete()
+      IngredientIndex.objects.bulk_create([IngredientIndex(ingredient_id=ingredient_id, stem=stem)
+                                           for ingredient_id, stem in sorted(entries - existing)])
 
-    ingredient_tokens = u' '.join([ingredient.search_name for ingredient in ingredients]).split()
-    ingredient_tokens = list(set(ingredient_tokens))
+    self.stdout.write(u'{0} ingredient stems indexed, {1} added, {2} removed'.format(
+      len(entries), len(entries - existing), len(stale_ids)))
 
-    for ingredient in ingredients:
-      search_values = ingredient.search_name.split()
-      for token in search_values:
-        if token in ingredient_tokens:
-          IngredientIndex.objects.create(ingredient=ingredient, stem=token)
+    invalidate_search_results()
@@ -0,0 +1,116 @@
+# encoding=utf8
+import os
+import codecs
+from time import time
+from multiprocessing import Pool, cpu_count
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.core.management.base import BaseCommand
+
+from searchengine.models import Recipe
+from searchengine.utils.text.processor import TextProcessor
+from searchengine.utils.text.indexer import DirectionsIndexer
+from searchengine.utils.search.cache import invalidate_search_results
+
+# TextProcessor of each worker process, created once by the pool initializer
+_processor = None
+
+
+def _start_worker():
+  global _processor
+  _processor = TextProcessor()
+
+
+def stem_chunk(rows):
+  """
+  Stems the directions of a chunk of recipes. Runs in the worker processes, which never touch the database.
+
+  :param rows: list of (recipe id, directions) tuples
+  :return: list of (recipe id, list of (stem, fulltext position, position) tuples)
+  """
+  return [(recipe_id, list(_processor.iter_indexed_stems(directions or u''))) for recipe_id, directions in rows]
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds DirectionsIndex and DirectionsFulltextIndex for the stored recipes, stemming them in parallel'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--workers', type=int, dest='workers', default=cpu_count(),
+                        help='Number of stemming processes (defaults to the number of cores)')
+    parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=200,
+                        help='Number of recipes sent to a worker at a time')
+    parser.add_argument('--start-id', type=int, dest='start_id', default=None,
+                        help='Only reindex recipes with a greater id (defaults to the last id in the progress file)')
+    parser.add_argument('--progress-file', dest='progress_file',
+                        default=os.path.join(settings.BASE_DIR, 'searchengine/data/reindex-directions.progress'),
+                        help='File the last reindexed recipe id is saved to, to resume an interrupted run')
+
+  def handle(self, *args, **options):
+    workers = max(options['workers'], 1)
+    chunk_size = max(options['chunk_size'], 1)
+    progress_file = options['progress_file']
+
+    last_id = options['start_id']
+    if last_id is None:
+      last_id = self.read_progress(progress_file)
+    if last_id > 0:
+      self.stdout.write(u'Resuming after recipe {0}'.format(last_id))
+
+    total = Recipe.objects.filter(pk__gt=last_id).count()
+    indexer = DirectionsIndexer()
+
+    # Workers are forked without any database connection, since only this process reads and writes
+    connections.close_all()
+    pool = Pool(workers, _start_worker) if workers > 1 else None
+    if pool is None:
+      _start_worker()
+
+    done = 0
+    start_time = time()
+    try:
+      while True:
+        # Each round reads one chunk per worker, keyset-paginated by id
+        rows = list(Recipe.objects.filter(pk__gt=last_id).order_by('id').values_list('id', 'directions')
+                    [:workers * chunk_size])
+        if len(rows) < 1:
+          break
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        stemmed = pool.map(stem_chunk, chunks) if pool is not None else map(stem_chunk, chunks)
+
+        # A round is written in one transaction, so an interrupted run can resume from the last saved id
+        with transaction.atomic():
+          indexer.remove_recipes([i[0] for i in rows])
+          for chunk in stemmed:
+            for recipe_id, indexed_stems in chunk:
+              indexer.add(recipe_id, indexed_stems)
+          indexer.flush()
+
+        last_id = rows[-1][0]
+        self.write_progress(progress_file, last_id)
+
+        done += len(rows)
+        elapsed = time() - start_time
+        self.stdout.write(u'Reindexed {0}/{1} recipes (up to id {2}), {3:.1f} recipes/s'.format(
+          done, total, last_id, done / elapsed if elapsed > 0 else 0.))
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+    if os.path.isfile(progress_file):
+      os.remove(progress_file)
+
+    self.stdout.write(u'Done; run check_scores --refresh to update the scores that depend on the new index')
+    invalidate_search_results()
+
+  def read_progress(self, progress_file):
+    if not os.path.isfile(progress_file):
+      return 0
+    with codecs.open(progress_file, 'r', 'utf-8') as f:
+      value = f.read().strip()
+    return int(value) if len(value) > 0 else 0
+
+  def write_progress(self, progress_file, last_id):
+    with codecs.open(progress_file, 'w', 'utf-8') as f:
+      f.write(u'{0}\n'.format(last_id))
@@ -0,0 +1,72 @@
+# encoding=utf8
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from searchengine.utils.search.cache import invalidate_search_results
+from searchengine.utils.scraper.pagecache import get_page_cache
+from searchengine.utils.scraper.sources import SOURCES
+
+
+class Command(BaseCommand):
+  help = 'Parses the recipe pages in the page cache again, and re-stores and re-indexes them, without any network access'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--source', dest='source', default=None, choices=[i[0] for i in SOURCES],
+                        help='Only reparse the pages of one source')
+    parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+                        help='Only parse the pages and report failures and timings, without touching the database')
+    parser.add_argument('--batch-size', type=int, dest='batch_size', default=100,
+                        help='Number of recipes stored per transaction')
+    parser.add_argument('--max-errors', type=int, dest='max_errors', default=20,
+                        help='Number of parse errors to print')
+
+  def handle(self, *args, **options):
+    page_cache = get_page_cache()
+    if not page_cache.enabled:
+      raise CommandError(u'The page cache is disabled (settings.PAGE_CACHE_DIR is None)')
+
+    scrapers = dict((domain, scraper()) for domain, scraper in SOURCES
+                    if options['source'] is None or domain == options['source'])
+
+    parsed = skipped = errors = 0
+    parse_time = 0.
+    batches = dict((domain, []) for domain in scrapers)
+    for page in page_cache:
+      domain = [i for i in scrapers if i in page['url']]
+      if len(domain) < 1:
+        continue
+      scraper = scrapers[domain[0]]
+
+      start_time = time()
+      try:
+        result = scraper.parse_recipe(dict(page['recipe']), page['html'])
+      except Exception as e:
+        errors += 1
+        if errors <= options['max_errors']:
+          self.stdout.write(u'Failed to parse {0}: {1!r}'.format(page['url'], e))
+        continue
+      finally:
+        parse_time += time() - start_time
+
+      if result is None:
+        skipped += 1
+        continue
+      parsed += 1
+
+      if not options['dry_run']:
+        batches[domain[0]].append(result)
+        if len(batches[domain[0]]) >= options['batch_size']:
+          scraper.save_recipes(batches[domain[0]], replace=True)
+          batches[domain[0]] = []
+
+    if not options['dry_run']:
+      for domain, batch in batches.items():
+        scrapers[domain].save_recipes(batch, replace=True)
+
+    self.stdout.write(u'{0} pages parsed, {1} without a usable recipe, {2} errors; {3:.3f}s spent parsing'.format(
+      parsed, skipped, errors, parse_time))
+
+    if not options['dry_run'] and parsed > 0:
+      self.stdout.write(u'Run score_recipes to score the reparsed recipes')
+      invalidate_search_results()
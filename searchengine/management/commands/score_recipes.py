@@ -1,13 +1,18 @@
 # encoding=utf8
-from math import log10
-
 from django.core.management.base import BaseCommand
-from searchengine.models import Recipe, DirectionsIndex, StemScore
+from searchengine.models import Recipe
+from searchengine.utils.search.scoring import stem_idfs, recipe_scores, save_scores
+from searchengine.utils.search.cache import invalidate_search_results
 
 
 class Command(BaseCommand):
   help = 'Assigns tf.idf scores to each recipe'
 
+  def add_arguments(self, parser):
+    parser.add_argument('--all', action='store_true', dest='all', default=False,
+                        help='Rescore every recipe, not just the ones that have no score yet')
+    parser.add_argument('--batch-size', type=int, dest='batch_size', default=250)
+
   def handle(self, *args, **options):
 
     # Just delete all the recipes for which we have no instructions
@@ -17,26 +22,15 @@ class Command(BaseCommand):
     Recipe.objects.filter(directions__exact='').delete()
 
     # Only want to play around with recipes that I haven't yet calculated the score for
-    recipes = Recipe.objects.filter(score__isnull=True).distinct()
+    recipes = Recipe.objects.all() if options['all'] else Recipe.objects.filter(score__isnull=True)
 
     n = Recipe.objects.all().count()
 
-    for recipe in recipes:
-      terms = DirectionsIndex.objects.filter(recipe=recipe).values_list('stem', flat=True).distinct()
-      for term in terms:
-        tf = DirectionsIndex.objects.filter(recipe=recipe).filter(stem__iexact=term).count()
-        tf = 1 + log10(tf)
-
-        if StemScore.objects.filter(stem__iexact=term).count() > 0:
-          idf = StemScore.objects.get(pk=term).idf
-        else:
-          df = DirectionsIndex.objects.filter(stem__iexact=term).values_list('recipe_id').distinct().count()
-          idf = 0 if df <= 0 else log10(n / float(df))
-          StemScore.objects.create(stem=term, idf=idf)
-
-        if recipe.score is not None or recipe.score <= 0:
-          recipe.score = tf * idf
-        else:
-          recipe.score += tf * idf
-
-      recipe.save()
+    # Term and document frequencies come out of one aggregation query each, instead of a query per (recipe, stem)
+    idfs = stem_idfs(n)
+    scores = recipe_scores(recipes, idfs)
+    save_scores(scores, batch_size=options['batch_size'])
+
+    self.stdout.write(u'Scored {0} recipes'.format(len(scores)))
+
+    invalidate_search_results()
@@ -2,11 +2,11 @@
 import os
 import time
 import codecs
-from math import log10
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from searchengine.models import Recipe, DirectionsIndex, StemScore
+from searchengine.models import Recipe, StemScore
+from searchengine.utils.search.scoring import document_frequencies, score_new_stems
 
 
 class Command(BaseCommand):
@@ -20,18 +20,16 @@ class Command(BaseCommand):
     Recipe.objects.filter(directions__isnull=True).delete()
     Recipe.objects.filter(directions__exact='').delete()
 
-    # Only want to play around with recipes that I haven't yet calculated the score for
-    stems = DirectionsIndex.objects.all().values_list('stem', flat=True).distinct()
-    stems = [i for i in stems if i not in StemScore.objects.all().values_list('stem', flat=True)]
+    # Only want to play around with stems that I haven't yet calculated the score for
+    # Document frequencies are maintained as recipes get indexed, so they don't have to be counted here
+    dfs = document_frequencies()
+    scored = set(StemScore.objects.all().values_list('stem', flat=True))
+    stems = [i for i in dfs if i not in scored]
 
     logfile_name = os.path.join(settings.BASE_DIR, time.strftime('searchengine/data/%Y%m%d-%H%M%S-stem-scoring.log'))
 
     n = Recipe.objects.all().count()
 
     with codecs.open(logfile_name, 'w', 'utf-8') as logfile:
-      for stem in stems:
-        df = DirectionsIndex.objects.filter(stem__iexact=stem).values_list('recipe_id').distinct().count()
-        idf = 0 if df <= 0 else log10(n / float(df))
-        StemScore.objects.create(stem=stem, idf=idf)
-        logfile.write(u'{0} {1}\n'.format(stem, idf))
-
+      for stem_score in score_new_stems(n, stems, dfs):
+        logfile.write(u'{0} {1}\n'.format(stem_score.stem, stem_score.idf))
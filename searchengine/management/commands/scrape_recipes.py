@@ -2,34 +2,52 @@
 import os
 import time
 import codecs
+from multiprocessing import cpu_count
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from searchengine.models import Ingredient
+from searchengine.utils.search.cache import invalidate_search_results
 from searchengine.utils.scraper.allrecipe import AllrecipeWebscraper
 from searchengine.utils.scraper.bigoven import BigOvenWebscraper
 from searchengine.utils.scraper.epicurious import EpicuriousWebscraper
+from searchengine.utils.scraper.pipeline import IngestPipeline
+from searchengine.utils.scraper.frontier import CrawlFrontier
 
 
 class Command(BaseCommand):
-  help = 'Closes the specified poll for voting'
+  help = 'Crawls the recipe sources for the queries in the crawl frontier, resuming wherever the last crawl stopped'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--seed', action='store_true', dest='seed', default=False,
+                        help='Queue every ingredient in the crawl frontier, the ones used by the most recipes first')
+    parser.add_argument('--query', action='append', dest='queries', default=None,
+                        help='Queue a query in the crawl frontier, ahead of the ingredients (can be repeated)')
+    parser.add_argument('--retry-failed', action='store_true', dest='retry_failed', default=False,
+                        help='Attempt the tasks that were given up on again')
+    parser.add_argument('--status', action='store_true', dest='status', default=False,
+                        help='Only print the number of tasks of each source in the crawl frontier')
+    parser.add_argument('--worker', dest='worker', default=None,
+                        help='Name of this worker, defaults to the host name and process id; restarting a worker under '
+                             'the same name resumes its claimed tasks')
+    parser.add_argument('--max-retries', type=int, dest='max_retries', default=None,
+                        help='Number of times a task is attempted before it is given up on')
+    parser.add_argument('--max-pages', type=int, dest='max_pages', default=1,
+                        help='Number of search result pages to crawl per source and query')
+    parser.add_argument('--max-recipes', type=int, dest='max_recipes', default=40,
+                        help='Number of recipes to scrape per source and query')
+    parser.add_argument('--parsers', type=int, dest='parsers', default=cpu_count(),
+                        help='Number of parser processes (0 parses in a thread of this process)')
+    parser.add_argument('--queue-size', type=int, dest='queue_size', default=100,
+                        help='Number of pages that can be waiting to be parsed or stored')
+    parser.add_argument('--batch-size', type=int, dest='batch_size', default=50,
+                        help='Number of recipes stored per transaction')
 
   def handle(self, *args, **options):
     ar_scraper = AllrecipeWebscraper()
     bo_scraper = BigOvenWebscraper()
     ep_scraper = EpicuriousWebscraper()
-    #
-    # with codecs.open(os.path.join(settings.BASE_DIR, 'searchengine/data/priority-ingredients.txt'), 'r', 'utf-8') as priority_ingredients_file:
-    #   ingredient_values = map(unicode.strip, priority_ingredients_file.readlines())
-    #   ingredient_values = [i.split(u',')[1] for i in ingredient_values if len(i) > 0]
-    #
-    # ingredients = Ingredient.objects.filter(search_name__iexact=ingredient_values[0])
-    # for i in range(1, len(ingredient_values)):
-    #   ingredients |= Ingredient.objects.filter(search_name__iexact=ingredient_values[i])
-    # ingredients = ingredients.distinct()
-
-    # ingredients = Ingredient.objects.all()
+    scrapers = [('AR', ar_scraper), ('BO', bo_scraper), ('EP', ep_scraper)]
 
     # Import ingredients if we don't already have an ingredients list
     # Format of ingredients is "display name,stemmed/search name"
@@ -41,123 +59,50 @@ class Command(BaseCommand):
     #   ingredients = [Ingredient.objects.create(display_name=i[0], search_name=i[1]) for i in ingredients
     #                  if len(i) >= 2 and isinstance(i, list)]
 
-    # Check to make sure that we don't have any ingredients in
-    # our ingredient list that we already completed our queries for
-    completed_ingredients_filename = os.path.join(settings.BASE_DIR, 'searchengine/data/completed-ingredients.txt')
-    # if os.path.isfile(completed_ingredients_filename):
-    #   with codecs.open(completed_ingredients_filename, 'r', 'utf-8') as completed_ingredients_file:
-    #     ingredient_names = [i for i in map(unicode.strip, completed_ingredients_file.readlines()) if len(i) > 0]
-    #   ingredients = [i for i in ingredients if i.search_name not in ingredient_names]
-
-    # Setup our logfile and our initial timer
-    previous_time = time.time()
+    # Every query, search result page and recipe page is a task in the crawl frontier, which keeps track of what is
+    # left to do across runs and workers (replacing completed-ingredients.txt)
+    frontier = CrawlFrontier(worker=options['worker'], max_retries=options['max_retries'])
+    if options['status']:
+      self.print_status(frontier)
+      return
+
+    if options['queries']:
+      self.stdout.write(u'Queued {0} search pages'.format(frontier.seed(scrapers, options['queries'])))
+    if options['seed']:
+      self.stdout.write(u'Queued {0} search pages'.format(frontier.seed(scrapers)))
+    if options['retry_failed']:
+      self.stdout.write(u'Put back {0} failed tasks'.format(frontier.retry_failed()))
+    released = frontier.release()
+    if released > 0:
+      self.stdout.write(u'Resuming {0} unfinished tasks'.format(released))
+
+    # The three sources are crawled in parallel, each throttled by its own per-host rate limit (see
+    # searchengine.utils.scraper.ratelimit) so we don't trip DDoS protections and get null-routed
+    # Or worse, have Amazon pull the plug on our AWS instance and threaten to close our AWS account
     logfile_name = os.path.join(settings.BASE_DIR, time.strftime('searchengine/data/%Y%m%d-%H%M%S-scraping.log'))
 
     with codecs.open(logfile_name, 'w', 'utf-8') as logfile:
-      for ingredient in ['clam chowder']:
-      # for ingredient in ingredients:
-        # We want to cap the total number of results for an initial run,
-        # particularly if only one of our sources is returning results
-        #
-        # Worst case scenario, given 20 unique results/query from a single source,
-        # this will take about 14 minutes with our self-imposed rate limit of 1 request/5 seconds
-        max_recipe_requests = 40
-
-        counter = 0  # Keeps track of the total number of unique recipes we have for our query
-
-        logfile.write(u'Scraping for recipes containing "{0}"...\n'.format(ingredient))  # .display_name))
-        # Resetting this on every loop so that we can have what is effectively a do while loop
-        ar_scraper.has_additional_results = True
-        bo_scraper.has_additional_results = True
-        ep_scraper.has_additional_results = True
-
-        # Also reset the contents of our results cache
-        ar_recipes = bo_recipes = ep_recipes = []
-
-        # Initialize search page counter
-        page = 0
-        while (ar_scraper.has_additional_results or
-               bo_scraper.has_additional_results or
-               ep_scraper.has_additional_results) and counter < max_recipe_requests:
-
-          # Artificially rate-limit our queries so we don't trip DDoS protections and get null-routed
-          # Or worse, have Amazon pull the plug on our AWS instance and threaten to close our AWS account
-          if time.time() - previous_time < 1:
-            time.sleep(1)
-            continue
-
-          # Increment on each pass through
-          page += 1
-
-          if ar_scraper.has_additional_results:
-            ar_recipes = ar_scraper.fetch_recipes(ingredient, page=page)
-            # ar_recipes = ar_scraper.fetch_recipes(ingredient.display_name, page=page)
-
-          if bo_scraper.has_additional_results:
-            bo_recipes = bo_scraper.fetch_recipes(ingredient, page=page)
-            # bo_recipes = bo_scraper.fetch_recipes(ingredient.display_name, page=page)
-
-          if ep_scraper.has_additional_results:
-            ep_recipes = ep_scraper.fetch_recipes(ingredient, page=page)
-            # ep_recipes = ep_scraper.fetch_recipes(ingredient.display_name, page=page)
-
-          # In the event that only one source is returning results, we want to limit the
-          # number of recipes we scrape because it significantly slows down our webscraper
-          has_additional_recipes = 1 if ar_recipes else 0
-          has_additional_recipes += 1 if bo_recipes else 0
-          has_additional_recipes += 1 if ep_recipes else 0
-
-          if has_additional_recipes <= 1 and max_recipe_requests >= 40:
-            max_recipe_requests = 20
-          elif has_additional_recipes > 1 and max_recipe_requests < 40:
-            max_recipe_requests = 40
-
-          recipe_count = len(ar_recipes + bo_recipes + ep_recipes)
-          if recipe_count > 0:
-            logfile.write(u'Retrieving {0} recipes...\n'.format(recipe_count))
-          else:
-            logfile.write(u'No new recipes found; continuing search.\n')
-            continue
-
-          # Reset request timer at the end to ensure we have a minimum of 5s between requests
-          # Doing it immediately after the time check would include time required to process each page,
-          # which doesn't accurately reflect when the actual request was issued
-          previous_time = time.time()
-
-          while ar_recipes or bo_recipes or ep_recipes and counter <= max_recipe_requests:
-            if time.time() - previous_time < 1:
-              time.sleep(1)
-              continue
-
-            if ar_recipes:
-              recipe = ar_recipes.pop()
-              logfile.write(u'AR | {0}\n'.format(unicode(recipe['name'])))
-              ar_scraper.fetch_recipe(recipe)
-
-            if bo_recipes:
-              recipe = bo_recipes.pop()
-              logfile.write(u'BO | {0}\n'.format(unicode(recipe['name'])))
-              bo_scraper.fetch_recipe(recipe)
-
-            if ep_recipes:
-              recipe = ep_recipes.pop()
-              logfile.write(u'EP | {0}\n'.format(unicode(recipe['name'])))
-              ep_scraper.fetch_recipe(recipe)
-
-            previous_time = time.time()
-            counter += 1
-
-          counter = max_recipe_requests + 100
-
-          if recipe_count > 0:
-            logfile.write(u'\n')
-
-        # Finally, write the search value of the ingredient to our completed ingredients file
-        try:
-          with codecs.open(completed_ingredients_filename, 'a', 'utf-8') as completed_ingredients_file:
-            completed_ingredients_file.write(u'{0}\n'.format(ingredient))  # .search_name))
-            # completed_ingredients_file.write(u'{0}\n'.format(ingredient.search_name))
-        except IOError:
-          with codecs.open(completed_ingredients_filename, 'w', 'utf-8') as completed_ingredients_file:
-            completed_ingredients_file.write(u'{0}\n'.format(ingredient))  # .search_name))
-            # completed_ingredients_file.write(u'{0}\n'.format(ingredient.search_name))
+      # Pages are fetched, parsed and stored by separate stages (see IngestPipeline)
+      pipeline = IngestPipeline(scrapers, parsers=options['parsers'], queue_size=options['queue_size'],
+                                batch_size=options['batch_size'], max_pages=options['max_pages'],
+                                max_recipes=options['max_recipes'], logfile=logfile)
+
+      previous_time = time.time()
+      try:
+        counts = pipeline.run(frontier)
+      finally:
+        pipeline.close()
+
+      logfile.write(u'Processed {0} tasks in {1:.1f}s ({2})\n'.format(
+        sum(counts.values()), time.time() - previous_time,
+        u', '.join(u'{0}: {1}'.format(label, count) for label, count in sorted(counts.items()))))
+      logfile.write(u''.join(u'{0}\n'.format(i) for i in pipeline.report(time.time() - previous_time)))
+
+    # Newly scraped recipes should show up in searches right away
+    invalidate_search_results()
+    self.print_status(frontier)
+
+  def print_status(self, frontier):
+    for source, statuses in sorted(frontier.stats().items()):
+      self.stdout.write(u'{0}: {1}'.format(source, u', '.join(u'{0} {1}'.format(count, status)
+                                                             for status, count in sorted(statuses.items()))))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2017-05-09 21:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchengine', '0011_auto_20170505_0831'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeFeatures',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='features', serialize=False, to='searchengine.Recipe')),
+                ('ingredient_count', models.IntegerField()),
+                ('ingredients_length', models.IntegerField()),
+                ('directions_length', models.IntegerField()),
+                ('source_weight', models.FloatField()),
+            ],
+        ),
+    ]
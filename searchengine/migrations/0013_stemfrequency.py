@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_document_frequencies(apps, schema_editor):
+    DirectionsIndex = apps.get_model('searchengine', 'DirectionsIndex')
+    StemFrequency = apps.get_model('searchengine', 'StemFrequency')
+    rows = DirectionsIndex.objects.order_by().values_list('stem').annotate(df=Count('recipe_id', distinct=True))
+    StemFrequency.objects.bulk_create([StemFrequency(stem=stem, df=df) for stem, df in rows.iterator()],
+                                      batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchengine', '0012_recipefeatures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StemFrequency',
+            fields=[
+                ('stem', models.CharField(max_length=60, primary_key=True, serialize=False)),
+                ('df', models.IntegerField()),
+            ],
+        ),
+        migrations.RunPython(count_document_frequencies, migrations.RunPython.noop),
+    ]
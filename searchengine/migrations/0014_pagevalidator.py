@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchengine', '0013_stemfrequency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageValidator',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.TextField(unique=True)),
+                ('etag', models.TextField(null=True)),
+                ('last_modified', models.CharField(max_length=40, null=True)),
+                ('fetched_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchengine', '0014_pagevalidator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=10)),
+                ('query', models.CharField(max_length=60)),
+                ('page', models.IntegerField()),
+                ('url', models.TextField(unique=True)),
+                ('recipe', models.TextField(null=True)),
+                ('priority', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('claimed', 'Claimed'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('retries', models.IntegerField(default=0)),
+                ('worker', models.CharField(max_length=100, null=True)),
+                ('claimed_at', models.DateTimeField(null=True)),
+                ('error', models.TextField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='crawltask',
+            index_together=set([('status', 'source', 'priority')]),
+        ),
+    ]
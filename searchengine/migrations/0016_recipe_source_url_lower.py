@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Recipes are looked up by case-folded URL (see Webscraper.stored_recipes), which only databases with expression
+# indexes can serve from an index
+INDEXED_VENDORS = ('postgresql', 'sqlite')
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor in INDEXED_VENDORS:
+        schema_editor.execute('CREATE INDEX searchengine_recipe_source_url_lower '
+                              'ON searchengine_recipe (LOWER(source_url))')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in INDEXED_VENDORS:
+        schema_editor.execute('DROP INDEX searchengine_recipe_source_url_lower')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchengine', '0015_crawltask'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -40,6 +40,14 @@ class StemScore(models.Model):
     return u', '.join(map(unicode, (self.stem, self.idf))).encode('utf-8')
 
 
+class StemFrequency(models.Model):
+  stem = models.CharField(max_length=60, primary_key=True)
+  df = models.IntegerField()
+
+  def __str__(self):
+    return u', '.join(map(unicode, (self.stem, self.df))).encode('utf-8')
+
+
 class DirectionsIndex(models.Model):
   recipe = models.ForeignKey(Recipe)
   stem = models.CharField(max_length=60)
@@ -56,3 +64,52 @@ class DirectionsFulltextIndex(models.Model):
 
   def __str__(self):
     return u', '.join(map(unicode, (self.recipe_id, self.stem, self.position))).encode('utf-8')
+
+
+class RecipeFeatures(models.Model):
+  recipe = models.OneToOneField(Recipe, primary_key=True, related_name='features')
+  ingredient_count = models.IntegerField()
+  ingredients_length = models.IntegerField()
+  directions_length = models.IntegerField()
+  source_weight = models.FloatField()
+
+  def __str__(self):
+    return u', '.join(map(unicode, (self.recipe_id, self.ingredient_count, self.ingredients_length,
+                                    self.directions_length, self.source_weight))).encode('utf-8')
+
+
+class PageValidator(models.Model):
+  url = models.TextField(unique=True)
+  etag = models.TextField(null=True)
+  last_modified = models.CharField(max_length=40, null=True)
+  fetched_at = models.DateTimeField(auto_now=True)
+
+  def __str__(self):
+    return u', '.join(map(unicode, (self.url, self.etag, self.last_modified))).encode('utf-8')
+
+
+class CrawlTask(models.Model):
+  PENDING = 'pending'
+  CLAIMED = 'claimed'
+  DONE = 'done'
+  FAILED = 'failed'
+  STATUSES = ((PENDING, 'Pending'), (CLAIMED, 'Claimed'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+  source = models.CharField(max_length=10)
+  query = models.CharField(max_length=60)
+  page = models.IntegerField()
+  url = models.TextField(unique=True)
+  recipe = models.TextField(null=True)
+  priority = models.IntegerField(default=0)
+  status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+  retries = models.IntegerField(default=0)
+  worker = models.CharField(max_length=100, null=True)
+  claimed_at = models.DateTimeField(null=True)
+  error = models.TextField(null=True)
+  updated_at = models.DateTimeField(auto_now=True)
+
+  class Meta:
+    index_together = [('status', 'source', 'priority')]
+
+  def __str__(self):
+    return u', '.join(map(unicode, (self.source, self.query, self.page, self.url, self.status))).encode('utf-8')
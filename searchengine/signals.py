@@ -0,0 +1,14 @@
+# coding=utf-8
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from searchengine.models import Recipe
+from searchengine.utils.search.scoring import forget_document_frequencies
+from searchengine.utils.scraper.dedup import get_known_urls
+
+
+@receiver(pre_delete, sender=Recipe)
+def forget_deleted_recipe(sender, instance, **kwargs):
+  # The recipe's DirectionsIndex rows are deleted along with it, so its stems lose a document
+  forget_document_frequencies([instance.id])
+  get_known_urls().discard(instance.source_url)
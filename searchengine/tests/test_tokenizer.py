@@ -0,0 +1,84 @@
+# coding=utf-8
+import random
+
+from django.test import SimpleTestCase
+
+from searchengine.utils.text.processor import TextProcessor
+
+
+class TokenizerTest(SimpleTestCase):
+  """
+  TextProcessor.tokenize_text has to produce the same tokens as tokenize_text_reference, which every index in the
+  database was built with.
+  """
+
+  def setUp(self):
+    self.processor = TextProcessor()
+
+  def assertTokens(self, text, tokens):
+    self.assertEqual(self.processor.tokenize_text_reference(text), tokens)
+    self.assertEqual(self.processor.tokenize_text(text), tokens)
+    self.assertEqual(list(self.processor.iter_tokens(text)), tokens)
+
+  def test_empty(self):
+    self.assertTokens(u'', [])
+    self.assertTokens(u'   \n\t ', [])
+    self.assertTokens(u'.,;!? - ()', [])
+
+  def test_words(self):
+    self.assertTokens(u'Preheat the oven.', [u'Preheat', u'the', u'oven'])
+    self.assertTokens(u'salt,pepper;  sugar\nflour', [u'salt', u'pepper', u'sugar', u'flour'])
+
+  def test_apostrophe_at_word_start(self):
+    self.assertTokens(u"'What a knob-end", [u'What', u'a', u'knob', u'end'])
+    self.assertTokens(u"a 'quoted' word", [u'a', u'quoted', u'word'])
+    self.assertTokens(u"''double", [u'double'])
+
+  def test_apostrophe_in_word(self):
+    self.assertTokens(u"brewer's yeast", [u"brewer's", u'yeast'])
+    self.assertTokens(u"Moscato d'Asti", [u'Moscato', u"d'Asti"])
+    self.assertTokens(u"rock'n'roll", [u"rock'n'roll"])
+    self.assertTokens(u"d''Asti", [u'd', u'Asti'])
+
+  def test_apostrophe_at_word_end(self):
+    self.assertTokens(u"the cooks' knives", [u'the', u'cooks', u'knives'])
+    self.assertTokens(u"knob-end'", [u'knob', u'end'])
+    self.assertTokens(u"end'.", [u'end'])
+    self.assertTokens(u"end'%", [u'end'])
+
+  def test_right_single_quote(self):
+    self.assertTokens(u'it’s', [u"it's"])
+    self.assertTokens(u'‘bird’s eye’ chilies', [u"bird's", u'eye', u'chilies'])
+
+  def test_percent_suffix(self):
+    self.assertTokens(u'2% milk', [u'2%', u'milk'])
+    self.assertTokens(u'100%', [u'100%'])
+    self.assertTokens(u'2%3', [u'2%', u'3'])
+    self.assertTokens(u'5%%', [u'5%'])
+    self.assertTokens(u'% of', [u'of'])
+    self.assertTokens(u"brewer's%", [u"brewer's%"])
+
+  def test_accented_characters(self):
+    self.assertTokens(u'Crème brûlée', [u'Creme', u'brulee'])
+    self.assertTokens(u'jalapeño', [u'jalapeno'])
+    self.assertTokens(u'Weißwurst', [u'Weisswurst'])
+    # Letters that aren't folded are kept as they are
+    self.assertTokens(u'çiğ köfte', [u'ciğ', u'kofte'])
+    self.assertTokens(u'寿司 rice', [u'寿司', u'rice'])
+
+  def test_underscores_and_digits(self):
+    self.assertTokens(u'foo_bar', [u'foo', u'bar'])
+    self.assertTokens(u'_leading and trailing_', [u'leading', u'and', u'trailing'])
+    self.assertTokens(u'bake at 350F for 1/2 hour', [u'bake', u'at', u'350F', u'for', u'1', u'2', u'hour'])
+    self.assertTokens(u'x2', [u'x2'])
+
+  def test_byte_strings(self):
+    self.assertTokens(b'plain ascii', [u'plain', u'ascii'])
+    self.assertTokens(u'café au lait'.encode('utf-8'), [u'cafe', u'au', u'lait'])
+
+  def test_random_documents(self):
+    alphabet = u"aBz09 _'’%.-\n\té寿ß²"
+    generator = random.Random(1)
+    for i in range(2000):
+      text = u''.join(generator.choice(alphabet) for j in range(generator.randint(0, 20)))
+      self.assertEqual(self.processor.tokenize_text(text), self.processor.tokenize_text_reference(text), repr(text))
@@ -1,11 +1,7 @@
-import requests
-from urllib import quote
-from bs4 import BeautifulSoup
 from titlecase import titlecase
 
 from searchengine.utils.scraper.webscraper import Webscraper
 from searchengine.utils.time import str_to_time
-from searchengine.models import Ingredient, Recipe
 
 class AllrecipeWebscraper(Webscraper):
   """
@@ -50,6 +46,12 @@ class AllrecipeWebscraper(Webscraper):
   def is_directions(self, tag):
     return self.not_empty(tag) and self.is_ol(tag) and self.has_class(tag, 'recipe-directions__list')
 
+  def keep_recipe_page_tag(self, name, attrs):
+    return (name == 'span' and self.start_tag_has_class(attrs, 'recipe-ingred_txt')) or \
+           (name == 'div' and self.start_tag_has_class(attrs, 'submitter__description')) or \
+           (name == 'time' and 'itemprop' in attrs) or \
+           (name == 'ol' and self.start_tag_has_class(attrs, 'recipe-directions__list'))
+
   def fetch_recipes(self, query, page=1):
     """
     Fetches recipes for a given query.
@@ -60,14 +62,12 @@ class AllrecipeWebscraper(Webscraper):
     """
     if page == 1:
       self.has_additional_results = True
-    query = quote(query.encode('utf8'))
-    search_url = self.base_search_url.format(query=query, page=page)
-    r = requests.get(search_url, headers=self.request_headers)
+    r = self.get(self.search_url(query, page))
     if r.status_code is not 200:
       self.has_additional_results = False
       return []
 
-    bs = BeautifulSoup(r.text, 'lxml')
+    bs = self.make_soup(r.text)
 
     # This is to ensure we get only recipe cards
     # Otherwise, we may get gallery or video cards, neither of which link to recipes
@@ -85,7 +85,7 @@ class AllrecipeWebscraper(Webscraper):
       recipe_url = self.base_recipe_url.format(recipe_url=recipe.find_all(self.is_recipe_link)[0]['href'])
 
       # Checking to make sure that the recipe doesn't already exist in the database
-      if len(Recipe.objects.filter(source_url__iexact=recipe_url)) > 0:
+      if recipe_url in self.known_urls:
         continue
 
       if len(recipe_url) < 1:
@@ -103,35 +103,22 @@ class AllrecipeWebscraper(Webscraper):
       recipes.append(recipe_dict)
     self.has_additional_results = len(recipes) > 0
 
-    source_urls = [r['source_url'] for r in recipes]
-    source_urls = [r.source_url for r in Recipe.objects.filter(source_url__in=source_urls)]
-    recipes = [r for r in recipes if r['source_url'] not in source_urls]
+    recipes = self.known_urls.unknown(recipes)
 
     return recipes
 
-  def fetch_recipe(self, recipe):
+  def parse_recipe(self, recipe, html):
     """
-    Fetches the recipe details for a given recipe.
+    Parses the recipe details out of a recipe page.
 
-    :param recipe:  Recipe a partially initialized Recipe object 
-    :return: Recipe a fully fleshed out Recipe object
+    :param recipe: dict a partially initialized Recipe
+    :param html: unicode HTML of the recipe page
+    :return: tuple (dict the fleshed out Recipe, list of ingredient strings), or None if the page has no usable recipe
     """
-    if Recipe.objects.filter(source_url__iexact=recipe['source_url']):
-      return
-
-    r = requests.get(recipe['source_url'], headers=self.request_headers)
-    if r.status_code is not 200:
-      return
-
-    bs = BeautifulSoup(r.text, 'lxml')
+    bs = self.make_soup(html, self.recipe_page_strainer)
 
     ingredients = [i.text.strip() for i in bs.find_all(self.is_ingredient)]
 
-    # We'll want to extract the ids of the ingredients hidden in the ingredient string which usually
-    # also contains the measurements and sometimes preparation instructions (like 'onions, chopped')
-    ingredient_ids = [self.text_processor.match_ingredient(i) for i in ingredients if i is not None]
-    ingredients = [Ingredient.objects.get(pk=i) for i in ingredient_ids if i is not None]
-
     description = bs.find_all(self.is_description)
     if description is not None and len(description) > 0:
       description = description[0]
@@ -159,11 +146,4 @@ class AllrecipeWebscraper(Webscraper):
     directions = bs.find_all(self.is_directions)[0]
     recipe['directions'] = u'\n'.join([i.text for i in directions.find_all('li')])
 
-    r = Recipe.objects.create(**recipe)
-    if len(ingredients) > 0:
-      for i in ingredients:
-        r.ingredients.add(i)
-
-    self.index_directions(r)
-
-    return r
+    return recipe, ingredients
@@ -1,11 +1,7 @@
-import requests
-from urllib import quote
-from bs4 import BeautifulSoup
 from titlecase import titlecase
 
 from searchengine.utils.scraper.webscraper import Webscraper
 from searchengine.utils.time import str_to_time
-from searchengine.models import Ingredient, Recipe
 
 
 class BigOvenWebscraper(Webscraper):
@@ -41,6 +37,13 @@ class BigOvenWebscraper(Webscraper):
   def is_directions(self, tag):
     return self.not_empty(tag) and self.is_div(tag) and tag.has_attr('id') and tag['id'] == 'instr'
 
+  def keep_recipe_page_tag(self, name, attrs):
+    return name == 'table' or \
+           (name == 'li' and self.start_tag_has_class(attrs, 'list-group-recipetile-1')) or \
+           (name == 'h1' and self.start_tag_has_class(attrs, 'fn')) or \
+           (name == 'time' and 'title' in attrs) or \
+           (name == 'div' and self.start_tag_has_class(attrs, 'display-field'))
+
   def fetch_recipes(self, query, page=1):
     """
     Fetches recipes for a given query.
@@ -51,14 +54,12 @@ class BigOvenWebscraper(Webscraper):
     """
     if page == 1:
       self.has_additional_results = True
-    query = quote(query.encode('utf8'))
-    search_url = self.base_search_url.format(query=query, page=page)
-    r = requests.get(search_url, headers=self.request_headers)
+    r = self.get(self.search_url(query, page))
     if r.status_code is not 200:
       self.has_additional_results = False
       return []
 
-    bs = BeautifulSoup(r.text, 'lxml')
+    bs = self.make_soup(r.text)
     recipe_cards = bs.find_all(self.is_recipe_card)
     recipes = []
     for recipe in recipe_cards:
@@ -85,27 +86,19 @@ class BigOvenWebscraper(Webscraper):
     # thorough job of getting us relevant data for those recipes
     recipes = [r for r in recipes if u'allrecipes.com' not in r['source_url']
                and u'epicurious.com' not in r['source_url']]
-    source_urls = [r['source_url'] for r in recipes]
-    source_urls = [r.source_url for r in Recipe.objects.filter(source_url__in=source_urls)]
-    recipes = [r for r in recipes if r['source_url'] not in source_urls]
+    recipes = self.known_urls.unknown(recipes)
 
     return recipes
 
-  def fetch_recipe(self, recipe):
+  def parse_recipe(self, recipe, html):
     """
-    Fetches the recipe details for a given recipe.
+    Parses the recipe details out of a recipe page.
 
-    :param recipe:  Recipe a partially initialized Recipe object 
-    :return: Recipe a fully fleshed out Recipe object
+    :param recipe: dict a partially initialized Recipe
+    :param html: unicode HTML of the recipe page
+    :return: tuple (dict the fleshed out Recipe, list of ingredient strings), or None if the page has no usable recipe
     """
-    if Recipe.objects.filter(source_url__iexact=recipe['source_url']):
-      return
-
-    r = requests.get(recipe['source_url'], headers=self.request_headers)
-    if r.status_code is not 200:
-      return
-
-    bs = BeautifulSoup(r.text, 'lxml')
+    bs = self.make_soup(html, self.recipe_page_strainer)
 
     # Check to see if recipe name has ellipsis & replace if it does
     if u'...' in recipe['name']:
@@ -128,11 +121,6 @@ class BigOvenWebscraper(Webscraper):
     if not 0 < len(temp_ingredients) < 100:
       return None
 
-    # Next, we'll want to extract the ids of the ingredients hidden in the ingredient string
-    # which usually also contains the measurements and sometimes preparation steps (like 'onions, chopped')
-    ingredient_ids = [self.text_processor.match_ingredient(i) for i in temp_ingredients if i is not None]
-    ingredients = [Ingredient.objects.get(pk=i) for i in ingredient_ids if i is not None]
-
     # BigOven never provides a recipe blurb/description, so we're skipping the description field
 
     # Total time may not be defined for a recipe
@@ -167,11 +155,5 @@ class BigOvenWebscraper(Webscraper):
       directions = [i.text.strip() for i in directions_container.find_all(self.is_directions)[0].find_all('p')]
 
     recipe['directions'] = u'\n'.join(directions)
-    r = Recipe.objects.create(**recipe)
-    if len(ingredients) > 0:
-      for i in ingredients:
-        r.ingredients.add(i)
-
-    self.index_directions(r)
 
-    return r
+    return recipe, temp_ingredients
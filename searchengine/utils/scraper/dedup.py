@@ -0,0 +1,69 @@
+# coding=utf-8
+from threading import Lock
+
+from searchengine.models import Recipe
+
+
+def normalize_url(url):
+  """
+  :param url: unicode Source URL of a recipe
+  :return: unicode Form of the URL used to detect duplicates; URLs were compared with iexact, so this is case-folded
+  """
+  return url.strip().lower()
+
+
+class KnownUrls(object):
+  """
+  Set of the (normalized) source URLs of every stored recipe, shared by the scrapers of a process so that checking
+  whether a recipe has already been scraped doesn't take a query.
+
+  Loaded from the database on first use, i.e. at the start of a crawl, and kept up to date as recipes are stored.
+  """
+
+  def __init__(self):
+    self.urls = None
+    self.lock = Lock()
+
+  def load(self):
+    urls = set(normalize_url(i) for i in Recipe.objects.values_list('source_url', flat=True).iterator())
+    with self.lock:
+      self.urls = urls
+    return self
+
+  def loaded(self):
+    if self.urls is None:
+      self.load()
+    return self.urls
+
+  def __contains__(self, url):
+    return normalize_url(url) in self.loaded()
+
+  def __len__(self):
+    return len(self.loaded())
+
+  def add(self, url):
+    with self.lock:
+      if self.urls is not None:
+        self.urls.add(normalize_url(url))
+
+  def discard(self, url):
+    with self.lock:
+      if self.urls is not None:
+        self.urls.discard(normalize_url(url))
+
+  def unknown(self, recipes):
+    """
+    :param recipes: list of dict Partially initialized recipes
+    :return: list of dict The recipes whose source URL isn't known yet
+    """
+    return [r for r in recipes if r['source_url'] not in self]
+
+
+_known_urls = KnownUrls()
+
+
+def get_known_urls():
+  """
+  :return: KnownUrls The process-wide set of known recipe URLs
+  """
+  return _known_urls
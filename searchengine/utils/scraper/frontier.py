@@ -0,0 +1,205 @@
+# coding=utf-8
+import os
+import json
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Case, Count, F, Max, Value, When
+from django.utils import timezone
+
+from searchengine.models import CrawlTask, Ingredient
+
+BATCH_SIZE = 250
+
+
+class CrawlFrontier(object):
+  """
+  Crawl work stored in the database (see CrawlTask), so that a crawl survives crashes and restarts, and can be shared
+  by several worker processes, on one or several machines.
+
+  Every task is either a page of search results (task.recipe is None) or a recipe page, found on such a page. Tasks are
+  unique by URL, so a recipe that shows up in the results of several queries is only fetched once. Workers claim pending
+  tasks in order of priority, which is the popularity of the ingredient they were queued for, and mark them done once
+  the recipe is stored, or put them back to be retried when they fail.
+  """
+
+  def __init__(self, worker=None, max_retries=None, claim_timeout=None):
+    """
+    :param worker: unicode Name of this worker, defaults to the host name and process id, so that every worker has its
+                   own; the tasks of a worker that crashed are put back once claim_timeout is up, or right away when it
+                   is restarted under a name given by hand (see release)
+    :param max_retries: int Number of times a task is attempted before it is given up on
+                        (defaults to settings.CRAWL_MAX_RETRIES, 3)
+    :param claim_timeout: int Seconds after which tasks claimed by a worker that never finished them are up for grabs
+                          again (defaults to settings.CRAWL_CLAIM_TIMEOUT, an hour)
+    """
+    self.worker = worker or u'{0}:{1}'.format(socket.gethostname(), os.getpid())
+    self.max_retries = max_retries if max_retries is not None else getattr(settings, 'CRAWL_MAX_RETRIES', 3)
+    self.claim_timeout = claim_timeout if claim_timeout is not None \
+      else getattr(settings, 'CRAWL_CLAIM_TIMEOUT', 3600)
+
+  def add(self, tasks):
+    """
+    Queues tasks. Those whose URL is already in the frontier are left as they are, except that they get the priority of
+    the new task if it is higher.
+
+    :param tasks: list of unsaved CrawlTask
+    :return: int Number of tasks queued
+    """
+    added = 0
+    for i in range(0, len(tasks), BATCH_SIZE):
+      batch = tasks[i:i + BATCH_SIZE]
+      while True:
+        existing = set(CrawlTask.objects.filter(url__in=[t.url for t in batch]).values_list('url', flat=True))
+        unique = dict((t.url, t) for t in batch if t.url not in existing)
+        try:
+          with transaction.atomic():
+            CrawlTask.objects.bulk_create(unique.values())
+          break
+        except IntegrityError:
+          continue  # Another worker queued some of the same URLs in the meantime
+      added += len(unique)
+
+      requeued = {}
+      for t in batch:
+        if t.url in existing:
+          requeued.setdefault(t.priority, []).append(t.url)
+      for priority, urls in requeued.items():
+        CrawlTask.objects.filter(url__in=urls, priority__lt=priority) \
+          .update(priority=priority, updated_at=timezone.now())
+    return added
+
+  def seed(self, scrapers, queries=None):
+    """
+    Queues the first page of search results of every query, for every source.
+
+    :param scrapers: list of (label, Webscraper) tuples
+    :param queries: list of unicode Queries to crawl, defaults to every ingredient, the ones used by the most recipes
+                    first
+    :return: int Number of tasks queued
+    """
+    by_hand = queries is not None
+    if not by_hand:
+      ingredients = Ingredient.objects.annotate(popularity=Count('recipe')).values_list('display_name', 'popularity')
+      queries = [(name, popularity) for name, popularity in ingredients.iterator()]
+    else:
+      # Queries given by hand go first, in order, ahead of every ingredient and of the queries given before them
+      top = max(Ingredient.objects.annotate(popularity=Count('recipe')).aggregate(top=Max('popularity'))['top'],
+                CrawlTask.objects.aggregate(top=Max('priority'))['top'])
+      queries = [(query, (top or 0) + len(queries) - i) for i, query in enumerate(queries)]
+
+    added = self.add([CrawlTask(source=label, query=query, page=1, url=scraper.search_url(query, 1),
+                                priority=popularity) for query, popularity in queries for label, scraper in scrapers])
+    if by_hand:
+      # The search pages and recipes already found for a query that is queued again move up along with it
+      for query, popularity in queries:
+        CrawlTask.objects.filter(query=query, priority__lt=popularity).update(priority=popularity,
+                                                                              updated_at=timezone.now())
+    return added
+
+  def add_page(self, task, url):
+    """
+    Queues the next page of search results after the one of a task.
+
+    :param task: CrawlTask Task of a page of search results
+    :param url: unicode URL of the next page
+    """
+    return self.add([CrawlTask(source=task.source, query=task.query, page=task.page + 1, url=url,
+                               priority=task.priority)])
+
+  def add_recipes(self, task, recipes, max_recipes=None):
+    """
+    Queues the recipes found on a page of search results.
+
+    :param task: CrawlTask Task of the page of search results
+    :param recipes: list of dict Partially initialized recipes found on the page
+    :param max_recipes: int Number of recipes to queue per source and query, or None for no limit
+    :return: int Number of recipes queued for the source and query so far
+    """
+    queued = CrawlTask.objects.filter(source=task.source, query=task.query, recipe__isnull=False).count()
+    if max_recipes is not None:
+      recipes = recipes[:max(max_recipes - queued, 0)]
+    return queued + self.add([CrawlTask(source=task.source, query=task.query, page=task.page, url=r['source_url'],
+                                        recipe=json.dumps(r), priority=task.priority) for r in recipes])
+
+  def claim(self, source, count):
+    """
+    Claims the pending tasks of a source with the highest priority. The recipe pages found on a page of search results
+    come right after it, so that a query is finished before the next one is started.
+
+    :param source: unicode Label of the source
+    :param count: int Number of tasks to claim
+    :return: list of CrawlTask The claimed tasks, possibly fewer than count, or none once the source is done
+    """
+    pending = CrawlTask.objects.filter(source=source, status=CrawlTask.PENDING) \
+      .order_by('-priority', 'query', 'page', 'id')
+    if connection.features.has_select_for_update_skip_locked:
+      # Rows locked by other workers are skipped rather than waited on
+      with transaction.atomic():
+        ids = list(pending.select_for_update(skip_locked=True).values_list('id', flat=True)[:count])
+        self.mark_claimed(ids)
+    else:
+      ids = list(pending.values_list('id', flat=True)[:count])
+      self.mark_claimed(ids)
+
+    return list(CrawlTask.objects.filter(pk__in=ids, status=CrawlTask.CLAIMED, worker=self.worker)
+                .order_by('-priority', 'query', 'page', 'id'))
+
+  def mark_claimed(self, task_ids):
+    # Only the tasks that are still pending are claimed, so a task never goes to two workers
+    now = timezone.now()
+    CrawlTask.objects.filter(pk__in=task_ids, status=CrawlTask.PENDING) \
+      .update(status=CrawlTask.CLAIMED, worker=self.worker, claimed_at=now, updated_at=now)
+
+  def complete(self, task_ids):
+    """
+    :param task_ids: list of int IDs of the tasks that are done
+    """
+    for i in range(0, len(task_ids), BATCH_SIZE):
+      CrawlTask.objects.filter(pk__in=task_ids[i:i + BATCH_SIZE]) \
+        .update(status=CrawlTask.DONE, error=None, updated_at=timezone.now())
+
+  def fail(self, task_id, error):
+    """
+    Puts a task back to be retried, or gives up on it once it has failed max_retries times.
+
+    :param task_id: int ID of the task that failed
+    :param error: unicode Why it failed
+    """
+    # A single update, so a failure is never counted twice (or lost) when workers fail the same task at once
+    CrawlTask.objects.filter(pk=task_id).update(
+      retries=F('retries') + 1, error=error, updated_at=timezone.now(),
+      status=Case(When(retries__gte=self.max_retries - 1, then=Value(CrawlTask.FAILED)),
+                  default=Value(CrawlTask.PENDING)))
+
+  def release(self):
+    """
+    Puts back the tasks this worker claimed without finishing them (e.g. before it crashed, if it has the same name),
+    as well as those of any worker that has held its tasks for longer than claim_timeout.
+
+    :return: int Number of tasks put back
+    """
+    now = timezone.now()
+    claimed = CrawlTask.objects.filter(status=CrawlTask.CLAIMED)
+    released = claimed.filter(worker=self.worker).update(status=CrawlTask.PENDING, updated_at=now)
+    expired = now - timedelta(seconds=self.claim_timeout)
+    return released + claimed.filter(claimed_at__lt=expired).update(status=CrawlTask.PENDING, updated_at=now)
+
+  def retry_failed(self):
+    """
+    :return: int Number of failed tasks put back to be attempted max_retries times again
+    """
+    return CrawlTask.objects.filter(status=CrawlTask.FAILED) \
+      .update(status=CrawlTask.PENDING, retries=0, updated_at=timezone.now())
+
+  def stats(self):
+    """
+    :return: dict Source label -> dict status -> number of tasks
+    """
+    stats = {}
+    for source, status, count in CrawlTask.objects.values_list('source', 'status').annotate(count=Count('id')) \
+        .order_by('source', 'status'):
+      stats.setdefault(source, {})[status] = count
+    return stats
@@ -0,0 +1,111 @@
+# coding=utf-8
+from urlparse import urlparse
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from django.conf import settings
+
+from searchengine.models import PageValidator
+
+
+class SessionPool(object):
+  """
+  One requests.Session per host, so that connections are kept alive and reused across requests to the same site.
+
+  Failed requests (connection errors, 429 and 5xx responses) are retried with exponential backoff, honouring
+  Retry-After. Responses are compressed, since the default headers ask for gzip/deflate.
+  """
+
+  def __init__(self, headers, retries=None, backoff=None, timeout=None, pool_size=None):
+    """
+    :param headers: dict Headers sent with every request
+    :param retries: int Number of retries (defaults to settings.SCRAPER_RETRIES, or 3)
+    :param backoff: float Backoff factor, in seconds (defaults to settings.SCRAPER_BACKOFF, or 1)
+    :param timeout: tuple (connect, read) timeouts in seconds (defaults to settings.SCRAPER_TIMEOUT, or (5, 30))
+    :param pool_size: int Connections kept open per host (defaults to settings.SCRAPER_POOL_SIZE, or 2)
+    """
+    self.headers = headers
+    self.retries = retries if retries is not None else getattr(settings, 'SCRAPER_RETRIES', 3)
+    self.backoff = backoff if backoff is not None else getattr(settings, 'SCRAPER_BACKOFF', 1.)
+    self.timeout = timeout if timeout is not None else getattr(settings, 'SCRAPER_TIMEOUT', (5, 30))
+    self.pool_size = pool_size if pool_size is not None else getattr(settings, 'SCRAPER_POOL_SIZE', 2)
+    self.sessions = {}
+    self.validators = {}  # URL of a fetched page -> (ETag, Last-Modified), until the page is stored
+    self.lock = Lock()
+
+  def session(self, url):
+    """
+    :param url: str URL about to be requested
+    :return: requests.Session Session for the host of the URL
+    """
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc.lower())
+    if key not in self.sessions:
+      session = requests.Session()
+      session.headers.update(self.headers)
+      retry = Retry(total=self.retries, backoff_factor=self.backoff, status_forcelist=(429, 500, 502, 503, 504),
+                    raise_on_status=False)
+      session.mount(u'{0}://'.format(parsed.scheme), HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                                                  max_retries=retry))
+      self.sessions[key] = session
+    return self.sessions[key]
+
+  def get(self, url, conditional=False):
+    """
+    Fetches a page.
+
+    Conditional requests send the ETag/Last-Modified validators saved from the last time the page was stored, so an
+    unchanged page comes back as an empty 304 Not Modified instead of being downloaded again. The validators of the
+    response are only held on to until the page is stored (see save_validators) or given up on (see
+    discard_validators), so that a page that never made it to the database is downloaded in full the next time.
+
+    :param url: str URL of the page
+    :param conditional: boolean Flag to make a conditional request, and keep the validators of the response
+    :return: requests.Response
+    """
+    headers = {}
+    if conditional:
+      validator = PageValidator.objects.filter(url=url).first()
+      if validator is not None:
+        if validator.etag:
+          headers['If-None-Match'] = validator.etag
+        if validator.last_modified:
+          headers['If-Modified-Since'] = validator.last_modified
+
+    response = self.session(url).get(url, headers=headers, timeout=self.timeout)
+
+    if conditional and response.status_code == 200:
+      etag = response.headers.get('ETag')
+      last_modified = response.headers.get('Last-Modified')
+      if etag or last_modified:
+        with self.lock:
+          self.validators[url] = (etag, last_modified)
+    return response
+
+  def save_validators(self, urls):
+    """
+    Saves the validators of pages once they are stored, for the next conditional requests.
+
+    :param urls: list of str URLs of the stored pages
+    """
+    with self.lock:
+      validators = [(url, self.validators.pop(url)) for url in urls if url in self.validators]
+    for url, (etag, last_modified) in validators:
+      PageValidator.objects.update_or_create(url=url, defaults={'etag': etag, 'last_modified': last_modified})
+
+  def discard_validators(self, urls):
+    """
+    Forgets the validators of pages that couldn't be parsed or stored.
+
+    :param urls: list of str URLs of the pages
+    """
+    with self.lock:
+      for url in urls:
+        self.validators.pop(url, None)
+
+  def close(self):
+    for session in self.sessions.values():
+      session.close()
+    self.sessions = {}
@@ -0,0 +1,91 @@
+# coding=utf-8
+import os
+import gzip
+import json
+from hashlib import sha1
+from tempfile import mkstemp
+
+from django.conf import settings
+
+
+class PageCache(object):
+  """
+  Raw recipe pages saved on disk as they are scraped, so that they can be parsed again without hitting the network.
+
+  Every page is a gzipped JSON file named after the SHA-1 of its URL, holding the URL, the partial recipe scraped from
+  the search results (name, image...) and the HTML of the page.
+  """
+
+  def __init__(self, directory):
+    """
+    :param directory: str Directory of the cache, or None to disable it
+    """
+    self.directory = directory
+
+  @property
+  def enabled(self):
+    return self.directory is not None
+
+  def path(self, url):
+    key = sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+  def put(self, url, recipe, html):
+    """
+    Saves a page, replacing any previous copy.
+
+    :param url: unicode URL of the page
+    :param recipe: dict Partial recipe the page was fetched for
+    :param html: unicode HTML of the page
+    """
+    if not self.enabled:
+      return
+    path = self.path(url)
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError:
+        pass  # Created by another thread in the meantime
+
+    # Written to a temporary file first, so that readers never see half a page
+    handle, temp_path = mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as f:
+      with gzip.GzipFile(fileobj=f, mode='wb') as page:
+        page.write(json.dumps({'url': url, 'recipe': recipe, 'html': html}))
+    os.rename(temp_path, path)
+
+  def load(self, path):
+    """
+    :param path: str Path of a cached page
+    :return: dict with the url, recipe and html of the page
+    """
+    with gzip.open(path, 'rb') as page:
+      return json.loads(page.read())
+
+  def get(self, url):
+    """
+    :param url: unicode URL of the page
+    :return: dict with the url, recipe and html of the page, or None if it isn't cached
+    """
+    if not self.enabled or not os.path.isfile(self.path(url)):
+      return None
+    return self.load(self.path(url))
+
+  def __iter__(self):
+    """
+    Iterates over every cached page, as dicts with the url, recipe and html of the page.
+    """
+    if not self.enabled or not os.path.isdir(self.directory):
+      return
+    for directory, subdirectories, filenames in os.walk(self.directory):
+      subdirectories.sort()
+      for filename in sorted(filenames):
+        if filename.endswith('.json.gz'):
+          yield self.load(os.path.join(directory, filename))
+
+
+def get_page_cache():
+  """
+  :return: PageCache Cache in settings.PAGE_CACHE_DIR (defaults to searchengine/data/pages, None disables it)
+  """
+  return PageCache(getattr(settings, 'PAGE_CACHE_DIR', os.path.join(settings.BASE_DIR, 'searchengine/data/pages')))
@@ -0,0 +1,420 @@
+# coding=utf-8
+import json
+from time import time
+from itertools import count
+from functools import partial
+from Queue import Queue, Empty
+from threading import Thread, Lock, Condition
+from multiprocessing import Pool, cpu_count
+
+from django.db import connections
+
+from searchengine.utils.text.matcher import get_ingredient_matcher
+from searchengine.utils.scraper.dedup import normalize_url
+from searchengine.utils.scraper.scheduler import CrawlScheduler
+
+# Scraper of each source in a parser process, and the ingredient matcher they share, set once by the pool initializer
+_parsers = {}
+_matcher = None
+
+
+def _start_parser(scraper_classes, matcher):
+  global _parsers, _matcher
+  _parsers = dict((label, scraper_class()) for label, scraper_class in scraper_classes.items())
+  _matcher = matcher
+
+
+def parse_page(label, recipe, html):
+  """
+  Parses a recipe page, and prepares the recipe to be stored (see Webscraper.prepare_recipe). Runs in the parser
+  processes, which never touch the database.
+
+  :param label: str Label of the source the page comes from
+  :param recipe: dict Partial recipe the page was fetched for
+  :param html: unicode HTML of the page
+  :return: tuple (label, URL of the page, result of prepare_recipe or None if the page has no usable recipe,
+                  seconds spent parsing, repr of the error or None)
+  """
+  start_time = time()
+  try:
+    parsed = _parsers[label].parse_recipe(dict(recipe), html)
+    if parsed is not None:
+      parsed = _parsers[label].prepare_recipe(*parsed, matcher=_matcher)
+    return label, recipe['source_url'], parsed, time() - start_time, None
+  except Exception as e:
+    return label, recipe['source_url'], None, time() - start_time, repr(e)
+
+
+class StageMetrics(object):
+  """
+  Number of items a pipeline stage went through, and the time it spent working on them.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.items = 0
+    self.busy = 0.
+    self.lock = Lock()
+
+  def record(self, items, seconds):
+    with self.lock:
+      self.items += items
+      self.busy += seconds
+
+  def report(self, elapsed):
+    return u'{0}: {1} items in {2:.1f}s of work, {3:.1f} items/s over {4:.1f}s'.format(
+      self.name, self.items, self.busy, self.items / elapsed if elapsed > 0 else 0., elapsed)
+
+
+class IngestPipeline(CrawlScheduler):
+  """
+  Crawls every source through three decoupled stages, so that parsing never holds up a rate-limited network slot:
+
+    fetch: one thread per source downloads recipe pages into a bounded queue (see CrawlScheduler)
+    parse: a pool of processes turns the pages into recipe records, with their ingredients matched and their directions
+           stemmed
+    write: a single thread stores the records in batches (see Webscraper.store_recipes)
+
+  The fetchers block once queue_size pages are waiting to be parsed or stored, which keeps memory bounded when the
+  database or the parsers fall behind. A page that fails in a stage, or whose parse never comes back, is logged and
+  dropped rather than holding up the pages behind it.
+
+  Queries are either crawled one at a time (crawl), or taken from a CrawlFrontier (run), in which case every task is
+  marked done once its recipe is stored, and put back to be retried if any stage fails on it.
+  """
+
+  def __init__(self, scrapers, parsers=None, queue_size=100, batch_size=50, flush_interval=5., claim_size=10,
+               parse_timeout=60., **kwargs):
+    """
+    :param scrapers: list of (label, Webscraper) tuples, e.g. ('AR', AllrecipeWebscraper())
+    :param parsers: int Number of parser processes (defaults to the number of cores; 0 parses in a thread instead)
+    :param queue_size: int Number of pages that can be waiting to be parsed or stored
+    :param batch_size: int Number of recipes stored per transaction
+    :param flush_interval: float Seconds after which a partial batch is stored anyway
+    :param claim_size: int Number of frontier tasks each source claims at a time
+    :param parse_timeout: float Seconds after which a page handed to the parser processes is given up on (e.g. if its
+                          parser process died)
+    """
+    CrawlScheduler.__init__(self, scrapers, **kwargs)
+    self.parsers = parsers if parsers is not None else cpu_count()
+    self.queue_size = queue_size
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.claim_size = claim_size
+    self.parse_timeout = parse_timeout
+    self.pool = None
+    self.matcher = None
+    self.claimed = set()
+    self.claimed_lock = Lock()
+    self.settled = Condition(self.claimed_lock)  # Notified whenever recipe pages leave the pipeline
+    self.frontier = None
+    self.tasks = {}  # URL of a recipe page -> its frontier task, until the recipe is stored
+    self.metrics = dict((name, StageMetrics(name)) for name in ('fetch', 'parse', 'write'))
+
+  def crawl(self, query):
+    """
+    Scrapes the recipes for a query from every source, returning once all of them are stored.
+
+    :param query: unicode Search query, e.g. an ingredient name
+    :return: dict Label -> number of recipes taken from the search results of that source, whether they were stored,
+             skipped as already known or failed (the count max_recipes limits, as in CrawlScheduler.crawl)
+    """
+    stages = self.start()
+    counts = CrawlScheduler.crawl(self, query)
+    self.finish(stages)
+    return counts
+
+  def run(self, frontier):
+    """
+    Works through the tasks of a crawl frontier, returning once none are left for any source.
+
+    :param frontier: CrawlFrontier
+    :return: dict Label -> number of tasks processed for that source
+    """
+    self.frontier = frontier
+    counts = dict((label, 0) for label, scraper in self.scrapers)
+    stages = self.start()
+    threads = [Thread(target=self.work_source, args=(label, scraper, counts), name=u'crawl-' + label)
+               for label, scraper in self.scrapers]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.finish(stages)
+    self.frontier = None
+    return counts
+
+  def start(self):
+    scraper_classes = dict((label, scraper.__class__) for label, scraper in self.scrapers)
+    # The ingredient matcher is loaded here and handed to the parsers, so that they never query the database; the
+    # parser processes are started again whenever it is rebuilt (see get_ingredient_matcher)
+    matcher = get_ingredient_matcher()
+    if matcher is not self.matcher:
+      self.close()
+      self.matcher = matcher
+    if self.parsers < 1:
+      _start_parser(scraper_classes, matcher)
+    elif self.pool is None:
+      # Parser processes are forked without any database connection
+      connections.close_all()
+      self.pool = Pool(self.parsers, _start_parser, (scraper_classes, matcher))
+
+    self.metrics = dict((name, StageMetrics(name)) for name in ('fetch', 'parse', 'write'))
+    with self.claimed_lock:
+      # Every crawl goes by the recipes stored so far (see claim), not by what earlier crawls attempted
+      self.claimed = set()
+    self.pages = Queue(self.queue_size)
+    self.records = Queue()
+    self.slots = Condition(Lock())  # Guards free_slots and parsing, and is notified when a slot is freed
+    self.free_slots = self.queue_size
+    self.parsing = {}  # Number of a page handed to the parse stage -> (time it was, page), until it is parsed
+    self.page_numbers = count()
+
+    stages = [Thread(target=self.dispatch, name=u'ingest-parse'), Thread(target=self.write, name=u'ingest-write')]
+    for thread in stages:
+      thread.start()
+    return stages
+
+  def finish(self, stages):
+    # Waits for every fetched page to go through the parse and write stages
+    self.pages.put(None)
+    for thread in stages:
+      thread.join()
+
+  def close(self):
+    # Every page has left the pipeline by now (see finish), and the pool would wait forever on any parse that was given
+    # up on, so its processes are stopped rather than waited for
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
+
+  def claim(self, scraper, url):
+    # A URL is only fetched once, even if it shows up again before the first copy is stored
+    with self.claimed_lock:
+      if url in scraper.known_urls or normalize_url(url) in self.claimed:
+        return False
+      self.claimed.add(normalize_url(url))
+      return True
+
+  def process_recipe(self, label, scraper, recipe):
+    if self.claim(scraper, recipe['source_url']):
+      self.fetch(label, scraper, recipe)
+
+  def fetch(self, label, scraper, recipe):
+    """
+    Fetch stage; runs in the thread of the recipe's source.
+
+    :return: int HTTP status code of the recipe page, which is only handed to the parse stage if it is 200, or 304 if
+             it was taken from the page cache (see Webscraper.fetch_page)
+    """
+    start_time = time()
+    status_code, html = scraper.fetch_page(recipe)
+    if html is None:
+      return status_code
+    self.metrics['fetch'].record(1, time() - start_time)
+
+    self.pages.put((label, recipe, html))
+    return status_code
+
+  def work_source(self, label, scraper, counts):
+    # Works through the frontier tasks of one source; runs in a thread per source, like crawl_source
+    try:
+      while True:
+        tasks = self.frontier.claim(label, self.claim_size)
+        if len(tasks) < 1:
+          # Pages still in the parse and write stages are put back if they fail, to be retried by this run
+          if self.wait_for_settled(label):
+            continue
+          break
+        for task in tasks:
+          try:
+            if task.recipe is None:
+              self.process_search_page(label, scraper, task)
+            else:
+              self.process_task(label, scraper, task)
+          except Exception as e:
+            self.log(u'{0} | Failed to process {1}: {2!r}\n'.format(label, task.url, e))
+            with self.claimed_lock:
+              self.tasks.pop(task.url, None)
+            self.frontier.fail(task.id, repr(e))
+          counts[label] += 1
+    except Exception as e:
+      # Claimed tasks are put back by CrawlFrontier.release, on the next run of this worker or once their claim expires
+      self.log(u'{0} | Crawl stopped: {1!r}\n'.format(label, e))
+    finally:
+      connections.close_all()
+
+  def wait_for_settled(self, label):
+    """
+    Waits for recipe pages of a source to leave the pipeline.
+
+    :param label: str Label of the source
+    :return: boolean False if none of the source's pages were in the pipeline, True once some may have left it
+    """
+    with self.claimed_lock:
+      if not any(task.source == label for task in self.tasks.values()):
+        return False
+      self.settled.wait(self.flush_interval)
+      return True
+
+  def process_search_page(self, label, scraper, task):
+    recipes = scraper.fetch_recipes(task.query, page=task.page)
+    self.log(u'{0} | Retrieving {1} recipes from page {2} of "{3}"...\n'.format(label, len(recipes), task.page,
+                                                                              task.query))
+    queued = self.frontier.add_recipes(task, recipes, self.max_recipes)
+    if scraper.has_additional_results and task.page < self.max_pages and \
+        (self.max_recipes is None or queued < self.max_recipes):
+      self.frontier.add_page(task, scraper.search_url(task.query, task.page + 1))
+    self.frontier.complete([task.id])
+
+  def process_task(self, label, scraper, task):
+    recipe = json.loads(task.recipe)
+    if recipe['source_url'] in scraper.known_urls:
+      self.frontier.complete([task.id])
+      return
+
+    self.log(u'{0} | {1}\n'.format(label, unicode(recipe['name'])))
+    with self.claimed_lock:
+      self.tasks[recipe['source_url']] = task
+    status_code = self.fetch(label, scraper, recipe)
+    if status_code not in (200, 304):
+      # The task is marked done once its recipe is stored, so a page the fetch stage never queued is a failure
+      with self.claimed_lock:
+        self.tasks.pop(recipe['source_url'], None)
+      self.frontier.fail(task.id, u'HTTP {0}'.format(status_code))
+
+  def dispatch(self):
+    # Parse stage; hands the fetched pages to the parser processes as they come in
+    while True:
+      page = self.pages.get()
+      if page is None:
+        break
+      self.acquire_slot()
+      number = next(self.page_numbers)
+      with self.slots:
+        self.parsing[number] = (time(), page)
+      try:
+        if self.pool is not None:
+          self.pool.apply_async(parse_page, page, callback=partial(self.parsed, number))
+        else:
+          self.parsed(number, parse_page(*page))
+      except Exception as e:
+        # The page still goes to the write stage, which frees its slot and settles its task
+        self.parsed(number, (page[0], page[1]['source_url'], None, 0., repr(e)))
+
+    # Every page has been parsed once all the slots are free again
+    for i in range(self.queue_size):
+      self.acquire_slot()
+    self.records.put(None)
+
+  def parsed(self, number, record):
+    # Hands a parsed page to the write stage, unless it was given up on in the meantime (see expire_parses)
+    with self.slots:
+      if self.parsing.pop(number, None) is None:
+        return
+    self.records.put(record)
+
+  def acquire_slot(self):
+    # Waits for one of the queue_size slots of the pages between the fetch and write stages to be free
+    with self.slots:
+      while self.free_slots < 1:
+        self.slots.wait(1.)
+        self.expire_parses()
+      self.free_slots -= 1
+
+  def release_slot(self):
+    with self.slots:
+      self.free_slots += 1
+      self.slots.notify()
+
+  def expire_parses(self):
+    # Gives up on the pages whose parse never came back, so that they can't wedge the pipeline; runs with slots held
+    now = time()
+    for number, (started_at, (label, recipe, html)) in self.parsing.items():
+      if now - started_at > self.parse_timeout:
+        del self.parsing[number]
+        self.records.put((label, recipe['source_url'], None, now - started_at,
+                          u'Not parsed after {0:.0f}s'.format(now - started_at)))
+
+  def write(self):
+    # Write stage; the only thread that stores recipes. It has to keep draining the records whatever fails, since the
+    # parse stage only goes on once the slots of the records are freed
+    scrapers = dict(self.scrapers)
+    batches = dict((label, []) for label in scrapers)
+    try:
+      while True:
+        try:
+          record = self.records.get(timeout=self.flush_interval)
+        except Empty:
+          self.flush(scrapers, batches)
+          continue
+        if record is None:
+          break
+
+        self.release_slot()
+        try:
+          self.add_record(scrapers, batches, record)
+        except Exception as e:
+          self.log(u'{0} | Failed to handle {1}: {2!r}\n'.format(record[0], record[1], e))
+
+      self.flush(scrapers, batches)
+    finally:
+      connections.close_all()
+
+  def add_record(self, scrapers, batches, record):
+    label, url, prepared, seconds, error = record
+    self.metrics['parse'].record(1, seconds)
+    if error is not None:
+      self.log(u'{0} | Failed to parse {1}: {2}\n'.format(label, url, error))
+      scrapers[label].sessions.discard_validators([url])
+      self.settle([url], error)
+    elif prepared is not None:
+      batches[label].append(prepared)
+      if len(batches[label]) >= self.batch_size:
+        self.flush(scrapers, batches, label)
+    else:
+      scrapers[label].sessions.discard_validators([url])
+      self.settle([url])  # No usable recipe on the page
+
+  def flush(self, scrapers, batches, label=None):
+    for batch_label in ([label] if label is not None else batches.keys()):
+      batch = batches[batch_label]
+      if len(batch) < 1:
+        continue
+      batches[batch_label] = []
+      start_time = time()
+      urls = [recipe['source_url'] for recipe, ingredient_ids, indexed_stems in batch]
+      error = None
+      try:
+        scrapers[batch_label].store_recipes(batch)
+      except Exception as e:
+        self.log(u'{0} | Failed to store {1} recipes: {2!r}\n'.format(batch_label, len(batch), e))
+        scrapers[batch_label].sessions.discard_validators(urls)
+        error = repr(e)
+      self.metrics['write'].record(len(batch), time() - start_time)
+      try:
+        self.settle(urls, error)
+      except Exception as e:
+        # Their tasks stay claimed until CrawlFrontier.release puts them back
+        self.log(u'{0} | Failed to settle {1} tasks: {2!r}\n'.format(batch_label, len(urls), e))
+
+  def settle(self, urls, error=None):
+    # Marks the frontier tasks of recipe pages done, or failed if there is an error, once they leave the pipeline
+    with self.claimed_lock:
+      task_ids = [self.tasks.pop(url).id for url in urls if url in self.tasks]
+      self.settled.notify_all()
+    if self.frontier is None or len(task_ids) < 1:
+      return
+    if error is None:
+      self.frontier.complete(task_ids)
+    else:
+      for task_id in task_ids:
+        self.frontier.fail(task_id, error)
+
+  def report(self, elapsed):
+    """
+    :param elapsed: float Seconds the crawl took
+    :return: list of unicode Throughput of each stage during the last crawl
+    """
+    return [self.metrics[name].report(elapsed) for name in ('fetch', 'parse', 'write')]
@@ -0,0 +1,98 @@
+# coding=utf-8
+from time import time, sleep
+from urlparse import urlparse
+from threading import Lock
+
+from django.conf import settings
+
+
+class TokenBucket(object):
+  """
+  Token bucket rate limiter, safe to share between threads.
+
+  Tokens accumulate at rate per second, up to capacity; every request spends one, waiting for it if the bucket is empty.
+  """
+
+  def __init__(self, rate, capacity=1):
+    """
+    :param rate: float Number of requests allowed per second
+    :param capacity: int Number of requests that can be made in a burst
+    """
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self.tokens = float(capacity)
+    self.updated = time()
+    self.lock = Lock()
+
+  def acquire(self):
+    """
+    Blocks until a request is allowed.
+
+    :return: float Number of seconds spent waiting
+    """
+    waited = 0.
+    while True:
+      with self.lock:
+        now = time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return waited
+        delay = (1 - self.tokens) / self.rate
+      sleep(delay)
+      waited += delay
+
+
+class HostRateLimiter(object):
+  """
+  Keeps one token bucket per host, so that every site gets its own allowance of requests.
+  """
+
+  def __init__(self, default_rate, rates=None, capacity=1):
+    """
+    :param default_rate: float Requests per second allowed for hosts without a rate of their own
+    :param rates: dict Host -> requests per second
+    :param capacity: int Number of requests that can be made to a host in a burst
+    """
+    self.default_rate = default_rate
+    self.rates = rates if rates is not None else {}
+    self.capacity = capacity
+    self.buckets = {}
+    self.lock = Lock()
+
+  def bucket(self, host):
+    with self.lock:
+      if host not in self.buckets:
+        self.buckets[host] = TokenBucket(self.rates.get(host, self.default_rate), self.capacity)
+      return self.buckets[host]
+
+  def wait(self, url):
+    """
+    Blocks until a request to the host of a URL is allowed.
+
+    :param url: str URL about to be requested
+    :return: float Number of seconds spent waiting
+    """
+    return self.bucket(urlparse(url).netloc.lower()).acquire()
+
+
+_limiter = None
+_limiter_lock = Lock()
+
+
+def get_rate_limiter():
+  """
+  Returns the process-wide rate limiter, shared by every scraper so that limits hold across threads. Rates come from
+  settings.SCRAPER_RATE_LIMIT (requests per second for any host, 1 by default), settings.SCRAPER_RATE_LIMITS
+  (host -> requests per second) and settings.SCRAPER_BURST (1 by default).
+
+  :return: HostRateLimiter
+  """
+  global _limiter
+  with _limiter_lock:
+    if _limiter is None:
+      _limiter = HostRateLimiter(getattr(settings, 'SCRAPER_RATE_LIMIT', 1.),
+                                 getattr(settings, 'SCRAPER_RATE_LIMITS', {}),
+                                 getattr(settings, 'SCRAPER_BURST', 1))
+    return _limiter
@@ -0,0 +1,73 @@
+# coding=utf-8
+from threading import Thread, Lock
+
+from django.db import connections
+
+
+class CrawlScheduler(object):
+  """
+  Crawls every source at the same time, with one thread per scraper.
+
+  Requests are throttled per host by the scrapers' rate limiter rather than by a global sleep, so a slow site only
+  holds up its own thread and the total request rate is the sum of every site's allowance.
+  """
+
+  def __init__(self, scrapers, max_pages=1, max_recipes=None, logfile=None):
+    """
+    :param scrapers: list of (label, Webscraper) tuples, e.g. ('AR', AllrecipeWebscraper())
+    :param max_pages: int Number of search result pages to crawl per source and query
+    :param max_recipes: int Number of recipes to scrape per source and query, or None for no limit
+    :param logfile: file Log to write progress to, shared by every thread
+    """
+    self.scrapers = scrapers
+    self.max_pages = max_pages
+    self.max_recipes = max_recipes
+    self.logfile = logfile
+    self.log_lock = Lock()
+
+  def log(self, message):
+    if self.logfile is None:
+      return
+    with self.log_lock:
+      self.logfile.write(message)
+
+  def crawl(self, query):
+    """
+    Scrapes the recipes for a query from every source, returning once all of them are done.
+
+    :param query: unicode Search query, e.g. an ingredient name
+    :return: dict Label -> number of recipes scraped from that source
+    """
+    counts = dict((label, 0) for label, scraper in self.scrapers)
+    threads = [Thread(target=self.crawl_source, args=(label, scraper, query, counts), name=u'crawl-' + label)
+               for label, scraper in self.scrapers]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return counts
+
+  def process_recipe(self, label, scraper, recipe):
+    # Fetches, parses and stores a recipe found in the search results; see IngestPipeline for the staged version
+    scraper.fetch_recipe(recipe)
+
+  def crawl_source(self, label, scraper, query, counts):
+    try:
+      for page in range(1, self.max_pages + 1):
+        recipes = scraper.fetch_recipes(query, page=page)
+        self.log(u'{0} | Retrieving {1} recipes from page {2}...\n'.format(label, len(recipes), page))
+
+        while recipes and (self.max_recipes is None or counts[label] < self.max_recipes):
+          recipe = recipes.pop()
+          self.log(u'{0} | {1}\n'.format(label, unicode(recipe['name'])))
+          self.process_recipe(label, scraper, recipe)
+          counts[label] += 1
+
+        if not scraper.has_additional_results or (self.max_recipes is not None and counts[label] >= self.max_recipes):
+          break
+    except Exception as e:
+      # One site failing shouldn't take the others down with it
+      self.log(u'{0} | Crawl of "{1}" failed: {2!r}\n'.format(label, query, e))
+    finally:
+      # Every thread gets its own database connections, which Django would otherwise leave open
+      connections.close_all()
@@ -0,0 +1,11 @@
+# coding=utf-8
+from searchengine.utils.scraper.allrecipe import AllrecipeWebscraper
+from searchengine.utils.scraper.bigoven import BigOvenWebscraper
+from searchengine.utils.scraper.epicurious import EpicuriousWebscraper
+
+# Domain of each source -> scraper that parses its pages
+SOURCES = (
+  (u'allrecipes.com', AllrecipeWebscraper),
+  (u'bigoven.com', BigOvenWebscraper),
+  (u'epicurious.com', EpicuriousWebscraper),
+)
@@ -1,18 +1,63 @@
+from abc import ABCMeta, abstractmethod
+from urllib import quote
+from bs4 import BeautifulSoup, SoupStrainer
 from requests.utils import default_headers
 from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models.functions import Lower
+from searchengine.models import Ingredient, Recipe, RecipeFeatures
 from searchengine.utils.text.processor import TextProcessor
-from searchengine.models import DirectionsIndex, DirectionsFulltextIndex
+from searchengine.utils.text.indexer import DirectionsIndexer
+from searchengine.utils.search.features import build_features
+from searchengine.utils.scraper.ratelimit import get_rate_limiter
+from searchengine.utils.scraper.http import SessionPool
+from searchengine.utils.scraper.pagecache import get_page_cache
+from searchengine.utils.scraper.dedup import get_known_urls, normalize_url
 
-class Webscraper:
+class Webscraper(object):
   """
   Parent class for all the webscrapers. Contains all the shared filters needed for BeautifulSoup.
   """
+  __metaclass__ = ABCMeta
+
   def __init__(self):
     self.has_additional_results = True
     self.text_processor = TextProcessor()
+    self.directions_indexer = DirectionsIndexer(self.text_processor)
     self.request_headers = default_headers()
     self.request_headers.update({'User-Agent': 'sfsu-csc849-webcrawler/1.0 ' + self.request_headers['User-Agent']})
     self.request_headers.update({'From': settings.CONTACT_EMAIL})
+    self.rate_limiter = get_rate_limiter()
+    self.sessions = SessionPool(self.request_headers)
+    self.page_cache = get_page_cache()
+    self.known_urls = get_known_urls()
+    self.use_strainers = getattr(settings, 'SCRAPER_STRAINERS', True)
+    self.recipe_page_strainer = SoupStrainer(self.keep_recipe_page_tag)
+
+  def get(self, url, conditional=False):
+    # Every request goes through the per-host rate limit, so that scrapers can safely run in parallel,
+    # and reuses the keep-alive connections of the host's session (see SessionPool.get for conditional requests)
+    self.rate_limiter.wait(url)
+    return self.sessions.get(url, conditional=conditional)
+
+  def search_url(self, query, page=1):
+    # Every scraper sets its own base_search_url, with the query and page to fill in
+    return self.base_search_url.format(query=quote(query.encode('utf8')), page=page)
+
+  def make_soup(self, html, strainer=None):
+    # Strainers only keep the tags a parser looks at (along with everything inside them),
+    # which saves building the tree for the rest of the page
+    return BeautifulSoup(html, 'lxml', parse_only=strainer if self.use_strainers else None)
+
+  def keep_recipe_page_tag(self, name, attrs):
+    # Overridden by each scraper with the tags parse_recipe looks at; strainer functions get the name and raw attributes
+    # of each start tag, since the tag itself hasn't been built yet
+    # Search pages are parsed in full, since only recipe pages are kept in the page cache for benchmark_parsers to check
+    return True
+
+  def start_tag_has_class(self, attrs, class_name):
+    # The raw attributes seen by strainers still hold the class as a space-separated string
+    return class_name in attrs.get('class', u'').split()
 
   def has_class(self, tag, class_name=None):
     if class_name is None:
@@ -59,14 +104,214 @@ class Webscraper:
   def is_p(self, tag):
     return tag.name == 'p'
 
-  def index_directions(self, recipe):
-    directions = recipe.directions
+  def fetch_page(self, recipe):
+    """
+    Downloads the page of a recipe, and keeps it in the page cache.
+
+    Validators are only saved for stored pages (see SessionPool.get), so a 304 Not Modified means the recipe was stored
+    once but isn't anymore; its page is then taken from the page cache, or downloaded in full if it isn't cached.
+
+    :param recipe: dict a partially initialized Recipe
+    :return: tuple (HTTP status code, unicode HTML of the page or None if it couldn't be fetched)
+    """
+    r = self.get(recipe['source_url'], conditional=True)
+    if r.status_code == 304:
+      page = self.page_cache.get(recipe['source_url'])
+      if page is not None:
+        return r.status_code, page['html']
+      r = self.get(recipe['source_url'])
+    if r.status_code != 200:
+      return r.status_code, None
+
+    self.page_cache.put(recipe['source_url'], recipe, r.text)
+    return r.status_code, r.text
+
+  def fetch_recipe(self, recipe):
+    """
+    Fetches the recipe details for a given recipe. The page is kept in the page cache, so that it can be parsed again
+    later without downloading it (see the reparse_recipes command).
+
+    :param recipe:  Recipe a partially initialized Recipe object
+    :return: Recipe a fully fleshed out Recipe object
+    """
+    if recipe['source_url'] in self.known_urls:
+      return
+
+    status_code, html = self.fetch_page(recipe)
+    if html is None:
+      return
+
+    try:
+      parsed = self.parse_recipe(dict(recipe), html)
+      if parsed is None:
+        return
+      return self.save_recipe(*parsed)
+    finally:
+      # Saved along with the recipe, unless it couldn't be parsed or stored
+      self.sessions.discard_validators([recipe['source_url']])
+
+  @abstractmethod
+  def fetch_recipes(self, query, page=1):
+    """
+    Scrapes a page of search results.
+
+    :param query: unicode Search query, e.g. an ingredient name
+    :param page: int Page of the results
+    :return: list of dict Partially initialized recipes found on the page
+    """
+
+  @abstractmethod
+  def parse_recipe(self, recipe, html):
+    """
+    Parses the page of a recipe, without touching the database (see parse_page in the ingest pipeline).
+
+    :param recipe: dict a partially initialized Recipe
+    :param html: unicode HTML of the recipe page
+    :return: tuple (dict a fully fleshed out Recipe, list of unicode ingredient strings), or None if the page doesn't
+             hold a usable recipe
+    """
+
+  def save_recipe(self, recipe, ingredient_strings, replace=False):
+    """
+    Stores a parsed recipe along with its ingredients, directions index and ranking features (see save_recipes).
 
-    direction_tokens = self.text_processor.stem_document(directions, remove_stopwords=True)
-    direction_fulltext_tokens = self.text_processor.stem_document(directions, remove_stopwords=False)
+    :param recipe: dict a fully fleshed out Recipe
+    :param ingredient_strings: list of unicode Ingredients listed by the recipe, with measurements and preparation
+    :param replace: boolean Flag to overwrite the recipe if it is already stored (its score is then reset)
+    :return: Recipe the stored Recipe
+    """
+    return self.save_recipes([(recipe, ingredient_strings)], replace=replace)[0]
 
-    for i in range(len(direction_tokens)):
-      DirectionsIndex.objects.create(recipe=recipe, stem=direction_tokens[i], position=i)
+  def prepare_recipe(self, recipe, ingredient_strings, matcher=None):
+    """
+    Does the work of storing a parsed recipe that doesn't need the database: matching its ingredient lines and stemming
+    its directions. The ingest pipeline runs it in its parser processes, so that the write stage only inserts rows.
 
-    for i in range(len(direction_fulltext_tokens)):
-      DirectionsFulltextIndex.objects.create(recipe=recipe, stem=direction_fulltext_tokens[i], position=i)
+    :param recipe: dict a fully fleshed out Recipe
+    :param ingredient_strings: list of unicode Ingredients listed by the recipe, with measurements and preparation
+    :param matcher: IngredientMatcher Matcher to use, defaults to the process-wide one
+    :return: tuple (dict the Recipe, list of int/None ids of the ingredient of each line, list of (stem, fulltext
+             position, position) tuples of the directions, as from TextProcessor.iter_indexed_stems)
+    """
+    # We'll want to extract the ids of the ingredients hidden in the ingredient string which usually
+    # also contains the measurements and sometimes preparation instructions (like 'onions, chopped')
+    ingredient_ids = self.text_processor.match_ingredients([i for i in ingredient_strings if i is not None],
+                                                           matcher=matcher)
+    indexed_stems = list(self.text_processor.iter_indexed_stems(recipe.get('directions') or u''))
+    return recipe, ingredient_ids, indexed_stems
+
+  def save_recipes(self, parsed_recipes, replace=False):
+    """
+    Stores a batch of parsed recipes along with their ingredients, directions index and ranking features (see
+    prepare_recipe and store_recipes).
+
+    :param parsed_recipes: list of (dict a fully fleshed out Recipe, list of unicode ingredient strings) tuples, as
+                           returned by parse_recipe
+    :param replace: boolean Flag to overwrite the recipes that are already stored (their scores are then reset)
+    :return: list of Recipe the stored Recipes, in the same order
+    """
+    return self.store_recipes([self.prepare_recipe(recipe, ingredient_strings)
+                               for recipe, ingredient_strings in parsed_recipes], replace=replace)
+
+  def store_recipes(self, prepared_recipes, replace=False):
+    """
+    Stores a batch of prepared recipes along with their ingredients, directions index and ranking features, in one
+    transaction and a constant number of queries for the whole batch.
+
+    :param prepared_recipes: list of tuples as returned by prepare_recipe
+    :param replace: boolean Flag to overwrite the recipes that are already stored (their scores are then reset)
+    :return: list of Recipe the stored Recipes, in the same order
+    """
+    if len(prepared_recipes) < 1:
+      return []
+
+    # The same page can show up more than once in a batch, in which case only the first copy is stored
+    # URLs are compared like KnownUrls does, i.e. case-insensitively
+    keys = [normalize_url(recipe['source_url']) for recipe, ingredient_ids, indexed_stems in prepared_recipes]
+    unique_keys = set()
+    batch = []
+    for key, (recipe, ingredient_ids, indexed_stems) in zip(keys, prepared_recipes):
+      if key not in unique_keys:
+        unique_keys.add(key)
+        batch.append((key, recipe, ingredient_ids, indexed_stems))
+
+    # The matched ingredients of the whole batch are checked in a single query
+    matched_ids = set(i for key, recipe, ids, indexed_stems in batch for i in ids if i is not None)
+    search_names = dict(Ingredient.objects.filter(pk__in=matched_ids).values_list('id', 'search_name')) \
+      if len(matched_ids) > 0 else {}
+
+    through = Recipe.ingredients.through
+
+    with transaction.atomic():
+      # Recipes that are already stored are left alone, unless they are to be replaced
+      stored = self.stored_recipes(unique_keys)
+      if not replace:
+        batch = [i for i in batch if i[0] not in stored]
+
+      replaced = []
+      for key, recipe, ids, indexed_stems in batch:
+        if key in stored:
+          r = stored[key]
+          # Fields the new parse leaves out go back to their defaults, rather than keeping what the old parse found
+          for field in Recipe._meta.concrete_fields:
+            if not field.primary_key:
+              setattr(r, field.attname, recipe.get(field.name, field.get_default()))
+          r.score = None  # Rescored by score_recipes
+          r.save()
+          replaced.append(r.id)
+      if len(replaced) > 0:
+        through.objects.filter(recipe_id__in=replaced).delete()
+        RecipeFeatures.objects.filter(recipe_id__in=replaced).delete()
+        self.directions_indexer.remove_recipes(replaced)
+
+      # Recipes stored by another process since they were looked up are left to it, rather than failing the whole batch
+      new_keys = set(key for key, recipe, ids, indexed_stems in batch if key not in stored)
+      while True:
+        try:
+          with transaction.atomic():
+            Recipe.objects.bulk_create([Recipe(**recipe) for key, recipe, ids, indexed_stems in batch
+                                        if key in new_keys])
+          break
+        except IntegrityError:
+          taken = self.stored_recipes(new_keys)
+          if len(taken) < 1:
+            raise
+          stored.update(taken)
+          new_keys -= set(taken)
+          batch = [i for i in batch if i[0] not in taken]
+
+      # Not every database hands back the ids of bulk inserted rows, so they're looked up by URL afterwards
+      if len(new_keys) > 0:
+        stored.update(self.stored_recipes(new_keys))
+      recipes = [stored[key] for key, recipe, ids, indexed_stems in batch]
+
+      links = []
+      features = []
+      for r, (key, recipe, ids, indexed_stems) in zip(recipes, batch):
+        ids = sorted(set(i for i in ids if i in search_names))
+        links += [through(recipe_id=r.id, ingredient_id=i) for i in ids]
+        features.append(build_features(r.id, r.source_url, r.directions, [search_names[i] for i in ids]))
+      through.objects.bulk_create(links)
+      RecipeFeatures.objects.bulk_create(features)
+
+      for r, (key, recipe, ids, indexed_stems) in zip(recipes, batch):
+        self.directions_indexer.add(r.id, indexed_stems)
+      self.directions_indexer.flush()
+
+    for r in recipes:
+      self.known_urls.add(r.source_url)
+    self.sessions.save_validators([recipe['source_url'] for recipe, ingredient_ids, indexed_stems in prepared_recipes])
+    return [stored[key] for key in keys]
+
+  def stored_recipes(self, keys):
+    """
+    Looks up recipes by case-folded URL, which is served by an index on LOWER(source_url) (see migration 0016).
+
+    :param keys: set of unicode Normalized source URLs (see normalize_url)
+    :return: dict Normalized source URL -> stored Recipe, for the URLs that are stored
+    """
+    recipes = Recipe.objects.annotate(normalized_url=Lower('source_url')).filter(normalized_url__in=keys)
+    return dict((normalize_url(r.source_url), r) for r in recipes)
+
+  def index_directions(self, recipe):
+    self.directions_indexer.index_recipes([recipe])
@@ -0,0 +1,122 @@
+# coding=utf-8
+import os
+from time import time
+from hashlib import md5
+from threading import Lock
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class LocalResultCache(object):
+  """
+  Search result cache kept in the memory of the current process, evicting the least recently used searches.
+
+  The generation of the cache is the modification time of a stamp file, so that commands run in other processes
+  (scraping, scoring...) can invalidate the results cached by every web server process on the machine.
+  """
+
+  def __init__(self, max_entries, timeout, stamp_path):
+    self.max_entries = max_entries
+    self.timeout = timeout
+    self.stamp_path = stamp_path
+    self.entries = OrderedDict()
+    self.lock = Lock()
+
+  def generation(self):
+    try:
+      return os.path.getmtime(self.stamp_path)
+    except OSError:
+      return 0.
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None or entry[0] < time():
+        return None
+      # Re-inserting the entry marks it as the most recently used
+      self.entries[key] = entry
+      return entry[1]
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (time() + self.timeout, value)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def invalidate(self):
+    with self.lock:
+      self.entries.clear()
+    with open(self.stamp_path, 'a'):
+      os.utime(self.stamp_path, None)
+
+
+class SharedResultCache(object):
+  """
+  Search result cache stored in one of the Django cache backends (settings.CACHES), shared by every process using it.
+
+  Eviction is left to the backend; the generation of the cache is a counter stored alongside the results.
+  """
+  generation_key = 'searchengine:results:generation'
+
+  def __init__(self, alias, timeout):
+    self.cache = caches[alias]
+    self.timeout = timeout
+
+  def make_key(self, key):
+    # Search keys can be longer than memcached allows, and contain spaces
+    return 'searchengine:results:' + md5(key.encode('utf-8')).hexdigest()
+
+  def generation(self):
+    generation = self.cache.get(self.generation_key)
+    if generation is None:
+      self.cache.add(self.generation_key, 1, None)
+      generation = self.cache.get(self.generation_key, 1)
+    return generation
+
+  def get(self, key):
+    return self.cache.get(self.make_key(key))
+
+  def set(self, key, value):
+    self.cache.set(self.make_key(key), value, self.timeout)
+
+  def invalidate(self):
+    try:
+      self.cache.incr(self.generation_key)
+    except ValueError:
+      self.cache.set(self.generation_key, 1, None)
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_result_cache():
+  """
+  Returns the search result cache configured by settings.SEARCH_CACHE_ALIAS: the process-local cache if it is None
+  (the default), or the Django cache with that alias otherwise.
+
+  :return: LocalResultCache/SharedResultCache
+  """
+  global _cache
+  with _cache_lock:
+    if _cache is None:
+      alias = getattr(settings, 'SEARCH_CACHE_ALIAS', None)
+      timeout = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 600)
+      if alias is None:
+        stamp_path = getattr(settings, 'SEARCH_CACHE_STAMP',
+                             os.path.join(settings.BASE_DIR, 'searchengine/data/search-results.stamp'))
+        _cache = LocalResultCache(getattr(settings, 'SEARCH_CACHE_MAX_ENTRIES', 1000), timeout, stamp_path)
+      else:
+        _cache = SharedResultCache(alias, timeout)
+    return _cache
+
+
+def invalidate_search_results():
+  """
+  Discards every cached search result (and the in-memory search index of every process) after the recipe collection
+  or its scores change.
+  """
+  get_result_cache().invalidate()
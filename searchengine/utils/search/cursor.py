@@ -0,0 +1,34 @@
+# coding=utf-8
+from django.core import signing
+
+CURSOR_SALT = 'searchengine.search.cursor'
+
+
+def encode_cursor(query_key, offset, score, recipe_id):
+  """
+  Builds the opaque cursor a search hands out for its next page of results.
+
+  :param query_key: unicode Identifies the search (and the generation of the results) the cursor belongs to
+  :param offset: int Number of results shown before the next page
+  :param score: float Score of the last result shown
+  :param recipe_id: int Id of the last result shown
+  :return: str URL-safe, signed cursor
+  """
+  return signing.dumps([query_key, offset, score, recipe_id], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor, query_key):
+  """
+  Reads a cursor handed out by encode_cursor.
+
+  :param cursor: str Cursor from the request
+  :param query_key: unicode Identifies the current search
+  :return: tuple (offset, score, recipe id), or None if the cursor is invalid or belongs to another search
+  """
+  try:
+    key, offset, score, recipe_id = signing.loads(cursor, salt=CURSOR_SALT)
+  except (signing.BadSignature, ValueError, TypeError):
+    return None
+  if key != query_key:
+    return None
+  return offset, score, recipe_id
@@ -0,0 +1,117 @@
+# coding=utf-8
+import numpy as np
+
+from searchengine.models import Recipe, RecipeFeatures
+
+
+def source_weight(source_url):
+  """
+  Score multiplier for the site a recipe was scraped from.
+
+  BigOven composes the majority of the collection and has a good deal of low-quality results
+  Epicurious, however, is only a small part of the collection and has high-quality results
+
+  :param source_url: unicode URL of the recipe
+  :return: float Multiplier for the recipe score
+  """
+  if 'bigoven' in source_url:
+    return 0.9
+  elif 'epicurious' in source_url:
+    return 1.5
+  return 1.0
+
+
+def build_features(recipe_id, source_url, directions, ingredient_names):
+  """
+  Computes the query-independent ranking features of a recipe.
+
+  :param recipe_id: int Id of the recipe
+  :param source_url: unicode URL of the recipe
+  :param directions: unicode Directions of the recipe
+  :param ingredient_names: list of unicode Search names of the recipe's ingredients
+  :return: RecipeFeatures Unsaved feature record for the recipe
+  """
+  return RecipeFeatures(
+    recipe_id=recipe_id,
+    ingredient_count=len(ingredient_names),
+    ingredients_length=len(u' '.join(ingredient_names).split()),
+    directions_length=len(directions.split()) if directions is not None else 0,
+    source_weight=source_weight(source_url)
+  )
+
+
+def compute_features(recipes):
+  """
+  Computes the ranking features for every recipe in a queryset, using two queries in total.
+
+  :param recipes: QuerySet of Recipe
+  :return: list of unsaved RecipeFeatures
+  """
+  recipe_ingredients = {}
+  links = Recipe.ingredients.through.objects.filter(recipe__in=recipes)
+  for recipe_id, search_name in links.values_list('recipe_id', 'ingredient__search_name').iterator():
+    recipe_ingredients.setdefault(recipe_id, []).append(search_name)
+
+  return [build_features(recipe_id, source_url, directions, recipe_ingredients.get(recipe_id, []))
+          for recipe_id, source_url, directions in recipes.values_list('id', 'source_url', 'directions').iterator()]
+
+
+class FeatureStore(object):
+  """
+  Ranking features and tf.idf scores of a set of recipes, stored column by column so that they can be scored as arrays.
+  """
+
+  def __init__(self, recipe_ids):
+    """
+    :param recipe_ids: numpy.ndarray Sorted recipe ids; the features of each recipe are stored at the same position
+    """
+    self.recipe_ids = recipe_ids
+    self.base_scores = np.zeros(len(recipe_ids), dtype=np.float64)
+    self.ingredient_counts = np.zeros(len(recipe_ids), dtype=np.int64)
+    self.ingredients_lengths = np.zeros(len(recipe_ids), dtype=np.int64)
+    self.directions_lengths = np.zeros(len(recipe_ids), dtype=np.int64)
+    self.source_weights = np.ones(len(recipe_ids), dtype=np.float64)
+
+  def load(self):
+    """
+    Loads the features from RecipeFeatures, computing them for the recipes that have not been backfilled yet.
+    """
+    rows = RecipeFeatures.objects.values_list('recipe_id', 'recipe__score', 'ingredient_count', 'ingredients_length',
+                                              'directions_length', 'source_weight')
+    found = self.fill(list(rows.iterator()))
+
+    missing = self.recipe_ids[~found].tolist()
+    if len(missing) > 0:
+      recipes = Recipe.objects.filter(pk__in=missing)
+      base_scores = dict(recipes.values_list('id', 'score'))
+      self.fill([(i.recipe_id, base_scores.get(i.recipe_id), i.ingredient_count, i.ingredients_length,
+                  i.directions_length, i.source_weight) for i in compute_features(recipes)])
+    return self
+
+  def fill(self, rows):
+    """
+    Stores feature rows of (recipe id, score, ingredient count, ingredients length, directions length, source weight).
+
+    :param rows: list of tuples Feature rows; rows for recipes outside the store are ignored
+    :return: numpy.ndarray Flags for the positions of the store that were filled in
+    """
+    filled = np.zeros(len(self.recipe_ids), dtype=bool)
+    if len(rows) < 1 or len(self.recipe_ids) < 1:
+      return filled
+
+    ids = np.array([i[0] for i in rows], dtype=np.int64)
+    positions = np.searchsorted(self.recipe_ids, ids)
+    valid = positions < len(self.recipe_ids)
+    valid[valid] = self.recipe_ids[positions[valid]] == ids[valid]
+    positions = positions[valid]
+
+    columns = zip(*rows)
+    self.base_scores[positions] = np.array([i if i is not None else 0. for i in columns[1]],
+                                           dtype=np.float64)[valid]
+    self.ingredient_counts[positions] = np.array(columns[2], dtype=np.int64)[valid]
+    self.ingredients_lengths[positions] = np.array(columns[3], dtype=np.int64)[valid]
+    self.directions_lengths[positions] = np.array(columns[4], dtype=np.int64)[valid]
+    self.source_weights[positions] = np.array(columns[5], dtype=np.float64)[valid]
+
+    filled[positions] = True
+    return filled
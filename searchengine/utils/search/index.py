@@ -0,0 +1,242 @@
+# coding=utf-8
+from time import time
+from threading import Lock
+from collections import namedtuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from django.conf import settings
+
+from searchengine.models import Ingredient, IngredientIndex, Recipe
+from searchengine.utils.search.postings import intersect_all
+from searchengine.utils.search.features import FeatureStore
+from searchengine.utils.search.ranking import score_candidates, top_k
+
+# Ingredients that are only "chicken", "beef" or "pork" in name (bouillon, stock, soup base...)
+# A search for chicken should return recipes that use chicken, not every recipe that calls for chicken stock
+BROTH_TYPES = (u'chicken', u'beef', u'pork')
+BROTH_KEYWORDS = (u'broth', u'base', u'soup', u'bouillon', u'stock')
+
+IngredientMatch = namedtuple('IngredientMatch', ['ingredient_ids', 'rows', 'full_matches', 'relaxed'])
+
+
+class IngredientSearchIndex(object):
+  """
+  Inverted index of the recipe collection by ingredient, kept in memory for the lifetime of the process.
+
+  Maps every ingredient stem (from IngredientIndex) to the ingredients that contain it, and holds the recipe x
+  ingredient incidence matrix (CSR) alongside the ranking features of every recipe in column-oriented arrays, so a
+  search is a handful of sparse matrix-vector products and array operations instead of running LIKE '%stem%'
+  queries joined against the recipe/ingredient table.
+  """
+
+  def __init__(self):
+    self.search_names = {}        # Ingredient id -> ingredient search name
+    self.stem_ingredients = {}    # Stem -> sorted list of ingredient ids
+    self.broth_ingredients = set()
+    self.columns = {}             # Ingredient id -> column of the ingredient in the matrix
+    self.recipe_ids = np.zeros(0, dtype=np.int64)  # Row -> recipe id, sorted
+    self.matrix = csr_matrix((0, 0), dtype=np.int32)
+    self.postings = csr_matrix((0, 0), dtype=np.int32)  # Transpose of the matrix; row -> recipes using an ingredient
+    self.broth_rows = np.zeros(0, dtype=bool)
+    self.features = None
+    self.built_at = None
+    self.generation = None
+
+  def build(self):
+    """
+    Loads the index from the database. Takes a constant number of queries, regardless of the size of the collection.
+    """
+    self.search_names = dict(Ingredient.objects.values_list('id', 'search_name').iterator())
+
+    stem_ingredients = {}
+    for ingredient_id, stem in IngredientIndex.objects.values_list('ingredient_id', 'stem').iterator():
+      stem_ingredients.setdefault(stem, set()).add(ingredient_id)
+    self.stem_ingredients = dict((stem, sorted(ids)) for stem, ids in stem_ingredients.items())
+
+    links = Recipe.ingredients.through.objects.values_list('recipe_id', 'ingredient_id')
+    links = np.array(list(links.iterator()), dtype=np.int64).reshape(-1, 2)
+
+    self.recipe_ids = np.unique(links[:, 0])
+    ingredient_ids = np.unique(links[:, 1])
+    self.columns = dict((ingredient_id, column) for column, ingredient_id in enumerate(ingredient_ids.tolist()))
+    self.matrix = csr_matrix((np.ones(len(links), dtype=np.int32),
+                              (np.searchsorted(self.recipe_ids, links[:, 0]),
+                               np.searchsorted(ingredient_ids, links[:, 1]))),
+                             shape=(len(self.recipe_ids), len(ingredient_ids)))
+    self.postings = self.matrix.T.tocsr()
+
+    # Same semantics as excluding search_name__contains=keyword, so this has to be a substring check
+    self.broth_ingredients = set(i for i, name in self.search_names.items()
+                                 if len([k for k in BROTH_KEYWORDS if k in name]) > 0)
+    self.broth_rows = self.recipe_hits(self.broth_ingredients) > 0
+
+    self.features = FeatureStore(self.recipe_ids).load()
+
+    self.built_at = time()
+    return self
+
+  def age(self):
+    return time() - self.built_at if self.built_at is not None else float('inf')
+
+  def match_ingredients(self, term):
+    """
+    Finds the ingredients whose search names contain a stemmed query term, e.g. 'celeri root'.
+
+    :param term: unicode Stemmed ingredient name from the query, with tokens separated by spaces
+    :return: list Sorted list of ingredient ids
+    """
+    tokens = term.split()
+    if len(tokens) < 1:
+      return []
+    candidates = intersect_all([self.stem_ingredients.get(token, []) for token in tokens])
+    if len(tokens) == 1:
+      return candidates
+
+    # Multi-word terms have to appear in that order in the ingredient name ('root celeri' is not 'celeri root')
+    padded_term = u' {0} '.format(u' '.join(tokens))
+    return [i for i in candidates if padded_term in u' {0} '.format(self.search_names.get(i, u''))]
+
+  def indicator(self, ingredient_ids):
+    """
+    :param ingredient_ids: iterable Ingredient ids
+    :return: numpy.ndarray Vector over the columns of the matrix, with a 1 for each of the given ingredients
+    """
+    indicator = np.zeros(self.matrix.shape[1], dtype=np.int32)
+    indicator[[self.columns[i] for i in ingredient_ids if i in self.columns]] = 1
+    return indicator
+
+  def recipe_hits(self, ingredient_ids):
+    """
+    Counts how many of the given ingredients each recipe uses, only touching the postings of those ingredients.
+
+    :param ingredient_ids: iterable Ingredient ids
+    :return: numpy.ndarray Number of the ingredients used by the recipe in each row of the matrix
+    """
+    columns = [self.columns[i] for i in ingredient_ids if i in self.columns]
+    if len(columns) < 1:
+      return np.zeros(self.matrix.shape[0], dtype=np.int64)
+    return np.bincount(self.postings[columns].indices, minlength=self.matrix.shape[0])
+
+  def search(self, terms, exclude_broths=False, min_results=10, recipes=None):
+    """
+    Retrieves the recipes for a list of stemmed query terms.
+
+    Recipes that contain every term are returned first; if there are fewer than min_results of those, the search is
+    relaxed to recipes that contain any of the terms.
+
+    :param terms: list of unicode Stemmed ingredient names
+    :param exclude_broths: boolean Flag to drop broths/stocks/soup bases, and the recipes that use them
+    :param min_results: int Number of strict matches below which the search is relaxed
+    :param recipes: list Sorted ids of the only recipes to consider (e.g. those matching a directions search), or None
+    :return: IngredientMatch Matched ingredient ids, the matrix rows of the recipes to rank, which of those rows are
+             strict matches, and whether we relaxed
+    """
+    ingredient_ids = set()
+    term_rows = []
+    for term in [t for t in terms if len(t.split()) > 0]:
+      term_ingredients = self.match_ingredients(term)
+      ingredient_ids.update(term_ingredients)
+      term_rows.append(self.recipe_hits(term_ingredients) > 0)
+
+    if exclude_broths:
+      ingredient_ids -= self.broth_ingredients
+
+    if len(term_rows) < 1:
+      return IngredientMatch(ingredient_ids, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), False)
+
+    allowed = ~self.broth_rows if exclude_broths else np.ones(self.matrix.shape[0], dtype=bool)
+    if recipes is not None:
+      allowed &= np.in1d(self.recipe_ids, recipes, assume_unique=True)
+    full_matches = np.logical_and.reduce(term_rows) & allowed
+
+    relaxed = np.count_nonzero(full_matches) < min_results
+    if relaxed:
+      rows = np.flatnonzero(np.logical_or.reduce(term_rows) & allowed)
+    else:
+      rows = np.flatnonzero(full_matches)
+
+    return IngredientMatch(ingredient_ids, rows, full_matches[rows], relaxed)
+
+  def rank(self, match, query_length, limit=None, after=None):
+    """
+    Ranks the recipes retrieved by a search, best first, stopping as soon as the best limit recipes are known.
+
+    Candidates are scored in blocks, in decreasing order of an upper bound on their score (the score they would get
+    if every one of their ingredients matched the search). Once the limit-th best score found so far beats the bound
+    of every candidate that is left, none of those can make the cut, so they are never scored.
+
+    :param match: IngredientMatch Results of IngredientSearchIndex.search
+    :param query_length: int Number of ingredients in the search
+    :param limit: int Number of results to return, or None for all of them
+    :param after: tuple (score, recipe id) of the last result already shown, to only rank the results that follow it
+    :return: list of (recipe id, score) tuples of the best limit recipes, sorted by descending score
+    """
+    rows = match.rows
+    if len(rows) < 1:
+      return []
+    limit = limit if limit is not None else len(rows)
+
+    recipe_ids = self.recipe_ids[rows]
+    full_matches = match.full_matches & match.relaxed
+    bounds = score_candidates(self.features, rows,
+                              np.minimum(self.features.ingredient_counts[rows], len(match.ingredient_ids)),
+                              query_length, full_matches)
+    indicator = self.indicator(match.ingredient_ids)
+
+    block_size = max(4 * limit, 256)
+    remaining = np.arange(len(rows))
+    best = np.zeros(0, dtype=np.int64)
+    best_scores = np.zeros(0, dtype=np.float64)
+    while len(remaining) > 0:
+      if len(remaining) > block_size:
+        partition = np.argpartition(-bounds[remaining], block_size - 1)
+        block, remaining = remaining[partition[:block_size]], remaining[partition[block_size:]]
+      else:
+        block, remaining = remaining, remaining[:0]
+
+      scores = score_candidates(self.features, rows[block], self.matrix[rows[block]].dot(indicator), query_length,
+                                full_matches[block])
+      if after is not None:
+        following = (scores < after[0]) | ((scores == after[0]) & (recipe_ids[block] > after[1]))
+        block, scores = block[following], scores[following]
+
+      block = np.concatenate((best, block))
+      scores = np.concatenate((best_scores, scores))
+      top = top_k(recipe_ids[block], scores, limit)
+      best, best_scores = block[top], scores[top]
+
+      if len(best) >= limit and len(remaining) > 0 and best_scores[-1] > bounds[remaining].max():
+        break
+
+    return list(zip(recipe_ids[best].tolist(), best_scores.tolist()))
+
+
+_index = None
+_index_lock = Lock()
+
+
+def get_ingredient_index(generation=None):
+  """
+  Returns the process-wide ingredient index, building it on first use and rebuilding it once it is older than
+  settings.SEARCH_INDEX_TTL seconds so that newly scraped recipes eventually show up in every worker process.
+
+  :param generation: Generation of the search result cache; the index is rebuilt as soon as it changes
+  :return: IngredientSearchIndex
+  """
+  global _index
+  ttl = getattr(settings, 'SEARCH_INDEX_TTL', 600)
+  with _index_lock:
+    if _index is None or _index.age() > ttl or (generation is not None and _index.generation != generation):
+      _index = IngredientSearchIndex().build()
+      _index.generation = generation
+    return _index
+
+
+def reset_ingredient_index():
+  """
+  Drops the process-wide ingredient index so that it is rebuilt on the next search.
+  """
+  global _index
+  with _index_lock:
+    _index = None
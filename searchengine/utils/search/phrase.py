@@ -0,0 +1,233 @@
+# coding=utf-8
+import os
+from abc import ABCMeta, abstractmethod
+from time import time
+from array import array
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+
+from searchengine.models import DirectionsFulltextIndex
+from searchengine.utils.search.postings import intersect_all
+from searchengine.utils.search.segment import SegmentReader
+
+
+class PositionalIndex(object):
+  """
+  Phrase and proximity searches over a positional index of the recipe directions, for searches such as "slow cooker"
+  or "no bake". Phrases and proximity are worked out on the positions of the recipes that contain every stem, all at
+  once, with numpy array operations.
+
+  Subclasses store the index, and provide term, postings and term_keys.
+  """
+  __metaclass__ = ABCMeta
+
+  @abstractmethod
+  def term(self, stem):
+    """
+    :param stem: unicode Stem to look up
+    :return: int Term number of the stem, or None if no recipe contains it
+    """
+
+  @abstractmethod
+  def postings(self, term):
+    """
+    :param term: int Term number of a stem
+    :return: numpy.ndarray Sorted ids of the recipes whose directions contain the stem
+    """
+
+  @abstractmethod
+  def term_keys(self, term, recipe_ids):
+    """
+    :param term: int Term number of a stem
+    :param recipe_ids: numpy.ndarray Sorted ids of recipes whose directions contain the stem
+    :return: numpy.ndarray Sorted keys (recipe id << 32 | position) of every position of the stem in those recipes
+    """
+
+  def age(self):
+    return time() - self.built_at if self.built_at is not None else float('inf')
+
+  def candidates(self, terms):
+    # Recipes that contain every term, anywhere in their directions
+    return intersect_all([self.postings(term).tolist() for term in set(terms)])
+
+  def phrase(self, stems):
+    """
+    Finds the recipes whose directions contain a phrase.
+
+    The positions of every stem of the phrase in the recipes that contain all of them, shifted back by the offset of
+    the stem in the phrase, are intersected with the positions of the first stem; whatever is left is where the phrase
+    starts. Positions are keyed by recipe, so this is done for every recipe at once.
+
+    :param stems: list of unicode Stems of the phrase, in order
+    :return: list Sorted ids of the matching recipes
+    """
+    terms = [self.term(stem) for stem in stems]
+    if len(terms) < 1 or None in terms:
+      return []
+    if len(terms) == 1:
+      return self.postings(terms[0]).tolist()
+
+    candidates = np.array(self.candidates(terms), dtype=np.int64)
+    if len(candidates) < 1:
+      return []
+    starts = self.term_keys(terms[0], candidates)
+    for offset, term in enumerate(terms[1:], 1):
+      starts = np.intersect1d(starts, self.term_keys(term, candidates) - offset, assume_unique=True)
+    return np.unique(starts >> 32).tolist()
+
+  def near(self, stems, distance):
+    """
+    Finds the recipes whose directions contain every stem, in any order, within distance positions of each other.
+
+    Such a window starts at a position of one of the stems, and the next position of every stem from there is at most
+    distance positions further, so every position of every stem is tried as a start, for every recipe at once.
+
+    :param stems: list of unicode Stems to look for
+    :param distance: int Largest number of positions between the first and the last of the stems
+    :return: list Sorted ids of the matching recipes
+    """
+    terms = [self.term(stem) for stem in set(stems)]
+    if len(terms) < 1 or None in terms:
+      return []
+    if len(terms) == 1:
+      return self.postings(terms[0]).tolist()
+
+    candidates = np.array(self.candidates(terms), dtype=np.int64)
+    if len(candidates) < 1:
+      return []
+    # Keys past the last position of a stem are infinitely far away
+    keys = [np.append(self.term_keys(term, candidates), np.iinfo(np.int64).max) for term in terms]
+    starts = np.concatenate([term_keys[:-1] for term_keys in keys])
+    matched = np.ones(len(starts), dtype=bool)
+    for term_keys in keys:
+      matched &= term_keys[np.searchsorted(term_keys, starts)] - starts <= distance
+    return np.unique(starts[matched] >> 32).tolist()
+
+  def search(self, clauses):
+    """
+    :param clauses: list of (list of unicode stems, int distance or None for a phrase) tuples, as from
+                    parse_directions_query
+    :return: list Sorted ids of the recipes that match every clause
+    """
+    return intersect_all([self.phrase(stems) if distance is None else self.near(stems, distance)
+                          for stems, distance in clauses])
+
+
+class DirectionsPhraseIndex(PositionalIndex):
+  """
+  Positional index of the recipe directions, loaded from DirectionsFulltextIndex (or DirectionsIndex) and kept in
+  memory.
+
+  Every (stem, recipe) pair is an entry, and the index is four flat arrays sorted by stem, recipe and position: the
+  entries of each stem, the recipe of each entry, and the positions of each entry. That's about 4 bytes per token of
+  directions, plus 12 per entry, instead of a Python object per row.
+  """
+
+  def __init__(self, model=DirectionsFulltextIndex):
+    """
+    :param model: Model Table of (recipe, stem, position) rows to load
+    """
+    self.model = model
+    self.terms = {}                                     # Stem -> term number
+    self.term_offsets = np.zeros(1, dtype=np.int64)     # Term number -> first entry of the term
+    self.recipe_ids = np.zeros(0, dtype=np.int32)       # Entry -> recipe id, sorted within each term
+    self.position_offsets = np.zeros(1, dtype=np.int64)  # Entry -> first position of the entry
+    self.positions = np.zeros(0, dtype=np.int32)        # Sorted within each entry
+    self.built_at = None
+    self.generation = None
+
+  def build(self):
+    """
+    Loads the index from the database, with a single query.
+    """
+    terms = {}
+    term_numbers = array('i')
+    recipe_ids = array('i')
+    positions = array('i')
+    for stem, recipe_id, position in self.model.objects.values_list('stem', 'recipe_id', 'position').iterator():
+      term_numbers.append(terms.setdefault(stem, len(terms)))
+      recipe_ids.append(recipe_id)
+      positions.append(position)
+
+    term_numbers = np.frombuffer(term_numbers, dtype=np.int32)
+    recipe_ids = np.frombuffer(recipe_ids, dtype=np.int32)
+    positions = np.frombuffer(positions, dtype=np.int32)
+    order = np.lexsort((positions, recipe_ids, term_numbers))
+    term_numbers, recipe_ids = term_numbers[order], recipe_ids[order]
+
+    # A new entry starts wherever the stem or the recipe changes
+    starts = np.flatnonzero(np.concatenate(([len(order) > 0], (np.diff(term_numbers) != 0) |
+                                                               (np.diff(recipe_ids) != 0))))
+    self.terms = terms
+    self.term_offsets = np.searchsorted(term_numbers[starts], np.arange(len(terms) + 1)).astype(np.int64)
+    self.recipe_ids = recipe_ids[starts]
+    self.position_offsets = np.append(starts, len(order)).astype(np.int64)
+    self.positions = positions[order]
+
+    self.built_at = time()
+    return self
+
+  def term(self, stem):
+    return self.terms.get(stem)
+
+  def postings(self, term):
+    return self.recipe_ids[self.term_offsets[term]:self.term_offsets[term + 1]]
+
+  def term_keys(self, term, recipe_ids):
+    start = self.term_offsets[term]
+    entries = start + np.searchsorted(self.recipe_ids[start:self.term_offsets[term + 1]], recipe_ids)
+    firsts = self.position_offsets[entries]
+    counts = self.position_offsets[entries + 1] - firsts
+    # Every position of the entries, one entry after the other
+    index = np.repeat(firsts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return (np.repeat(recipe_ids.astype(np.int64), counts) << 32) | self.positions[index]
+
+
+class SegmentPhraseIndex(SegmentReader, PositionalIndex):
+  """
+  Positional index of the recipe directions, read from a segment file written by the build_segments command.
+  """
+
+  def __init__(self, path):
+    SegmentReader.__init__(self, path)
+    self.built_at = time()
+    self.generation = None
+
+
+_index = None
+_index_lock = Lock()
+
+
+def get_phrase_index(generation=None):
+  """
+  Returns the process-wide phrase index, building it on first use and rebuilding it once it is older than
+  settings.SEARCH_INDEX_TTL seconds or the search result cache is invalidated (see get_ingredient_index).
+
+  The index is read from the segment file in settings.DIRECTIONS_SEGMENT if there is one, in which case it is only as
+  recent as the last run of build_segments, and loaded from DirectionsFulltextIndex otherwise.
+
+  :param generation: Generation of the search result cache; the index is rebuilt as soon as it changes
+  :return: PositionalIndex
+  """
+  global _index
+  ttl = getattr(settings, 'SEARCH_INDEX_TTL', 600)
+  with _index_lock:
+    if _index is None or _index.age() > ttl or (generation is not None and _index.generation != generation):
+      path = getattr(settings, 'DIRECTIONS_SEGMENT', None)
+      if path is not None and os.path.isfile(path):
+        _index = SegmentPhraseIndex(path)
+      else:
+        _index = DirectionsPhraseIndex().build()
+      _index.generation = generation
+    return _index
+
+
+def reset_phrase_index():
+  """
+  Drops the process-wide phrase index so that it is rebuilt on the next search.
+  """
+  global _index
+  with _index_lock:
+    _index = None
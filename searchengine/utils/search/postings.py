@@ -0,0 +1,44 @@
+# coding=utf-8
+from bisect import bisect_left
+
+
+def intersect_all(postings):
+  """
+  Intersects any number of sorted posting lists, starting with the shortest ones to keep intermediate results small.
+
+  Each list is walked in lockstep with the result so far, unless it is much longer than the result, in which case we
+  binary search it for each id in the result instead (e.g. 'saffron' vs. 'salt').
+
+  :param postings: list of sorted lists of recipe ids
+  :return: list Sorted list of the recipe ids found in every list
+  """
+  if len(postings) < 1:
+    return []
+  postings = sorted(postings, key=len)
+  result = list(postings[0])
+  for posting in postings[1:]:
+    if len(result) < 1:
+      break
+
+    common = []
+    if len(result) * 8 < len(posting):
+      position = 0
+      for recipe_id in result:
+        position = bisect_left(posting, recipe_id, position)
+        if position >= len(posting):
+          break
+        if posting[position] == recipe_id:
+          common.append(recipe_id)
+    else:
+      i = j = 0
+      while i < len(result) and j < len(posting):
+        if result[i] == posting[j]:
+          common.append(result[i])
+          i += 1
+          j += 1
+        elif result[i] < posting[j]:
+          i += 1
+        else:
+          j += 1
+    result = common
+  return result
@@ -0,0 +1,66 @@
+# coding=utf-8
+import re
+
+from searchengine.utils.search.index import BROTH_TYPES, BROTH_KEYWORDS
+
+
+def parse_query(query, processor):
+  """
+  Turns the comma-separated ingredient names of a search into their canonical form, so that searches such as
+  'Chicken, rice' and 'rice,chicken,chicken' are treated as the same search.
+
+  :param query: unicode Ingredient names separated by commas
+  :param processor: TextProcessor Processor used to stem the ingredient names
+  :return: tuple (sorted list of the unique stemmed, lowercased ingredient names, flag to exclude broths)
+  """
+  query_ingredients = set()
+  for name in query.split(u','):
+    name = u' '.join(processor.stem_many(name.strip().split())).lower()
+    if len(name) > 0:
+      query_ingredients.add(name)
+  query_ingredients = sorted(query_ingredients)
+
+  # Check to see if we should be excluding broths from our query
+  ingredient_string = u','.join(query_ingredients)
+
+  exclude_broths = len([i for i in BROTH_TYPES if i in ingredient_string]) > 0
+  if exclude_broths:
+    exclude_broths = not len([i for i in BROTH_KEYWORDS if i in ingredient_string]) > 0
+
+  return query_ingredients, exclude_broths
+
+
+# Trailing '~N' of a directions clause, for words that have to be within N positions of each other
+DISTANCE_PATTERN = re.compile(u'~\\s*(\\d+)\\s*$', re.UNICODE)
+
+
+def parse_directions_query(query, processor):
+  """
+  Turns the comma-separated clauses of a directions search into their canonical form.
+
+  Every clause is a phrase that has to appear in the directions as is ('slow cooker', '"no bake"'), or, when followed
+  by '~N', words that have to appear within N positions of each other, in any order ('dough rest~5').
+
+  :param query: unicode Directions clauses separated by commas
+  :param processor: TextProcessor Processor used to stem the clauses, the same way the directions were indexed
+  :return: list of (tuple of unicode stems, int distance or None for a phrase) tuples, sorted and without duplicates
+  """
+  clauses = set()
+  for clause in query.split(u','):
+    distance = DISTANCE_PATTERN.search(clause)
+    if distance is not None:
+      clause = clause[:distance.start()]
+      distance = int(distance.group(1))
+    stems = tuple(processor.stem_document(clause))
+    if len(stems) > 0:
+      clauses.add((stems, distance))
+  return sorted(clauses)
+
+
+def format_directions_query(clauses):
+  """
+  :param clauses: list of (tuple of unicode stems, int distance or None) tuples, as from parse_directions_query
+  :return: unicode Canonical string of the clauses, e.g. for cache keys
+  """
+  return u','.join(u' '.join(stems) + (u'~{0}'.format(distance) if distance is not None else u'')
+                   for stems, distance in clauses)
@@ -0,0 +1,54 @@
+# coding=utf-8
+import numpy as np
+
+
+def score_candidates(features, rows, match_counts, query_length, full_matches):
+  """
+  Scores the candidate recipes of a search, all at once.
+
+  :param features: FeatureStore Ranking features of every recipe in the index
+  :param rows: numpy.ndarray Positions of the candidate recipes in the feature store
+  :param match_counts: numpy.ndarray Number of each candidate's ingredients that match the search
+  :param query_length: int Number of ingredients in the search
+  :param full_matches: numpy.ndarray Flags for the candidates that have all the ingredients of a relaxed search
+  :return: numpy.ndarray Score of each candidate recipe
+  """
+  ingredient_counts = np.maximum(features.ingredient_counts[rows], 1)
+
+  # Integer division on purpose - this is how the (int / int) ratio in the original per-recipe formula evaluated
+  scores = features.base_scores[rows] + 0.5 * match_counts * ((query_length + ingredient_counts) //
+                                                              (query_length * ingredient_counts))
+
+  # Super-score/rank recipes that have all ingredients if we had to relax our search
+  scores += 10 * full_matches
+
+  # Score adjustments based on source (see features.source_weight)
+  scores *= features.source_weights[rows]
+
+  # Penalize recipes which have overly long ingredient lists relative to the recipe directions
+  scores[features.directions_lengths[rows] < features.ingredients_lengths[rows] * 2] *= 0.1
+
+  return scores
+
+
+def top_k(recipe_ids, scores, k):
+  """
+  Finds the k best scores without sorting every score, breaking ties by recipe id.
+
+  :param recipe_ids: numpy.ndarray Recipe id of each score
+  :param scores: numpy.ndarray Scores to rank
+  :param k: int Number of results to return
+  :return: numpy.ndarray Positions of the k best scores, best first
+  """
+  if k < 1 or len(scores) < 1:
+    return np.zeros(0, dtype=np.int64)
+
+  if k < len(scores):
+    # Everything tied with the k-th best score is kept, so ties are broken the same way no matter the partitioning
+    kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+    positions = np.flatnonzero(scores >= kth_score)
+  else:
+    positions = np.arange(len(scores))
+
+  order = np.lexsort((recipe_ids[positions], -scores[positions]))
+  return positions[order[:k]]
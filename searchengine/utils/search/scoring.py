@@ -0,0 +1,235 @@
+# coding=utf-8
+from math import log10
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Case, Count, F, FloatField, Min, Value, When
+
+from searchengine.models import Recipe, DirectionsIndex, StemScore, StemFrequency
+
+# Number of values per IN (...) clause or CASE statement, well below SQLite's limit on query parameters
+BATCH_SIZE = 250
+
+
+def count_document_frequencies():
+  """
+  Counts the recipes whose directions contain each stem, in a single GROUP BY over DirectionsIndex.
+
+  :return: dict Stem -> number of recipes that use it
+  """
+  rows = DirectionsIndex.objects.order_by().values_list('stem').annotate(df=Count('recipe_id', distinct=True))
+  return dict(rows.iterator())
+
+
+def document_frequencies():
+  """
+  :return: dict Stem -> number of recipes that use it, as maintained in StemFrequency
+  """
+  return dict(StemFrequency.objects.values_list('stem', 'df').iterator())
+
+
+def upsert_statement():
+  """
+  :return: str INSERT into StemFrequency that adds to the df of the stems that are already there, with a {values}
+           placeholder for the rows, or None if the database has no such statement
+  """
+  table = connection.ops.quote_name(StemFrequency._meta.db_table)
+  if connection.vendor == 'postgresql' or \
+      (connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 24, 0)):
+    return u'INSERT INTO {0} (stem, df) VALUES {{values}} ON CONFLICT (stem) DO UPDATE SET df = {0}.df + excluded.df' \
+      .format(table)
+  elif connection.vendor == 'mysql':
+    return u'INSERT INTO {0} (stem, df) VALUES {{values}} ON DUPLICATE KEY UPDATE df = df + VALUES(df)'.format(table)
+  return None
+
+
+def update_document_frequencies(changes):
+  """
+  Applies changes to the document frequencies in StemFrequency, as recipes are indexed or removed from the index.
+
+  Changes are applied with one INSERT ... ON CONFLICT DO UPDATE SET df = df + change per batch, so that several
+  writers (scraper threads or worker processes) can add the same new stem at once. Stems are written in sorted order,
+  so concurrent transactions lock their rows in the same order and never deadlock.
+
+  :param changes: dict Stem -> change in the number of recipes that use it
+  """
+  stems = sorted(stem for stem, change in changes.items() if change != 0)
+  if len(stems) < 1:
+    return
+
+  statement = upsert_statement()
+  with transaction.atomic():
+    for i in range(0, len(stems), BATCH_SIZE):
+      batch = stems[i:i + BATCH_SIZE]
+      if statement is not None:
+        with connection.cursor() as cursor:
+          cursor.execute(statement.format(values=u', '.join([u'(%s, %s)'] * len(batch))),
+                         [value for stem in batch for value in (stem, changes[stem])])
+      else:
+        update_stem_frequencies(batch, changes)
+
+    # Stems that are no longer used by any recipe
+    for i in range(0, len(stems), BATCH_SIZE):
+      StemFrequency.objects.filter(stem__in=stems[i:i + BATCH_SIZE], df__lte=0).delete()
+
+
+def update_stem_frequencies(stems, changes):
+  # Fallback for databases without an upsert: adds the stems that are missing, starting over if another writer adds
+  # some of them in the meantime
+  while True:
+    try:
+      with transaction.atomic():
+        existing = set(StemFrequency.objects.filter(stem__in=stems).values_list('stem', flat=True))
+        for stem in stems:
+          if stem in existing:
+            StemFrequency.objects.filter(stem=stem).update(df=F('df') + changes[stem])
+        StemFrequency.objects.bulk_create([StemFrequency(stem=stem, df=changes[stem]) for stem in stems
+                                           if stem not in existing])
+      return
+    except IntegrityError:
+      continue
+
+
+def forget_document_frequencies(recipe_ids):
+  """
+  Takes recipes out of the document frequencies. Has to run before their DirectionsIndex rows are deleted.
+
+  :param recipe_ids: list of int Ids of the recipes about to be removed from the index
+  """
+  changes = {}
+  for i in range(0, len(recipe_ids), BATCH_SIZE):
+    rows = DirectionsIndex.objects.filter(recipe_id__in=recipe_ids[i:i + BATCH_SIZE]).order_by() \
+      .values_list('stem').annotate(df=Count('recipe_id', distinct=True))
+    for stem, df in rows.iterator():
+      changes[stem] = changes.get(stem, 0) - df
+  update_document_frequencies(changes)
+
+
+def rebuild_document_frequencies():
+  """
+  Recounts StemFrequency from scratch, for when it has drifted from DirectionsIndex.
+  """
+  frequencies = count_document_frequencies()
+  with transaction.atomic():
+    StemFrequency.objects.all().delete()
+    StemFrequency.objects.bulk_create([StemFrequency(stem=stem, df=df) for stem, df in frequencies.items()],
+                                      batch_size=BATCH_SIZE)
+
+
+def inverse_document_frequency(df, n):
+  """
+  :param df: int Number of recipes that use a stem
+  :param n: int Number of recipes in the collection
+  :return: float idf of the stem
+  """
+  return 0 if df <= 0 else log10(n / float(df))
+
+
+def score_new_stems(n, stems, dfs):
+  """
+  Computes and stores the idf of stems that have no StemScore yet.
+
+  :param n: int Number of recipes in the collection
+  :param stems: iterable Stems without a StemScore
+  :param dfs: dict Stem -> document frequency (see document_frequencies)
+  :return: list of StemScore The new scores
+  """
+  new_scores = [StemScore(stem=stem, idf=inverse_document_frequency(dfs.get(stem, 0), n)) for stem in stems]
+  StemScore.objects.bulk_create(new_scores, batch_size=BATCH_SIZE)
+  return new_scores
+
+
+def stem_idfs(n):
+  """
+  Looks up the idf of every stem in StemScore, computing and storing the ones that have not been scored yet.
+
+  :param n: int Number of recipes in the collection
+  :return: dict Stem -> idf
+  """
+  idfs = dict(StemScore.objects.values_list('stem', 'idf').iterator())
+  dfs = document_frequencies()
+  missing = [stem for stem in dfs if stem not in idfs]
+
+  if len(missing) > 0:
+    idfs.update((i.stem, i.idf) for i in score_new_stems(n, missing, dfs))
+  return idfs
+
+
+def stale_stems(n, tolerance):
+  """
+  Finds the stems whose stored idf has drifted from the one given by the current document frequencies.
+
+  :param n: int Number of recipes in the collection
+  :param tolerance: float Largest drift that is still considered fresh
+  :return: dict Stem -> (stored idf, current idf)
+  """
+  dfs = document_frequencies()
+  stale = {}
+  for stem, idf in StemScore.objects.values_list('stem', 'idf').iterator():
+    current = inverse_document_frequency(dfs.get(stem, 0), n)
+    if abs(current - idf) > tolerance:
+      stale[stem] = (idf, current)
+  return stale
+
+
+def stale_recipes(stems):
+  """
+  :param stems: iterable Stems whose idf is stale (see stale_stems)
+  :return: set Ids of the recipes whose score is missing or depends on one of the stems
+  """
+  stems = sorted(stems)
+  recipe_ids = set(Recipe.objects.filter(score__isnull=True).values_list('id', flat=True).iterator())
+  for i in range(0, len(stems), BATCH_SIZE):
+    rows = DirectionsIndex.objects.filter(stem__in=stems[i:i + BATCH_SIZE]).order_by() \
+      .values_list('recipe_id', flat=True).distinct()
+    recipe_ids.update(rows.iterator())
+  return recipe_ids
+
+
+def recipe_scores(recipes, idfs):
+  """
+  Computes the tf.idf score of recipes from their directions, streaming one GROUP BY (recipe, stem) aggregation.
+
+  A recipe's score is the (1 + log10(tf)) * idf weight of the last distinct stem of its directions (the one whose first
+  occurrence comes last), which is what the original per-stem loop ended up storing, since every stem overwrote the
+  running total. The search ranking (see ranking.score_candidates) is tuned to that scale.
+
+  :param recipes: QuerySet of Recipe to score
+  :param idfs: dict Stem -> idf (see stem_idfs)
+  :return: dict Recipe id -> score
+  """
+  term_frequencies = DirectionsIndex.objects.filter(recipe__in=recipes).order_by() \
+    .values_list('recipe_id', 'stem').annotate(tf=Count('id'), first_position=Min('position'))
+
+  last_stems = {}
+  for recipe_id, stem, tf, first_position in term_frequencies.iterator():
+    if recipe_id not in last_stems or first_position > last_stems[recipe_id][0]:
+      last_stems[recipe_id] = (first_position, (1 + log10(tf)) * idfs.get(stem, 0))
+  return dict((recipe_id, score) for recipe_id, (first_position, score) in last_stems.items())
+
+
+def save_values(model, field, values, batch_size=BATCH_SIZE):
+  """
+  Writes one float field of many rows with one UPDATE ... CASE statement per batch, in a single transaction.
+
+  :param model: Model class of the rows
+  :param field: str Name of the field to write
+  :param values: dict Primary key -> value
+  :param batch_size: int Number of rows per UPDATE
+  """
+  keys = sorted(values)
+  with transaction.atomic():
+    for i in range(0, len(keys), batch_size):
+      batch = keys[i:i + batch_size]
+      model.objects.filter(pk__in=batch).update(**{
+        field: Case(*[When(pk=key, then=Value(values[key])) for key in batch], output_field=FloatField())
+      })
+
+
+def save_scores(scores, batch_size=BATCH_SIZE):
+  """
+  Writes recipe scores back in bulk (see save_values).
+
+  :param scores: dict Recipe id -> score
+  :param batch_size: int Number of recipes per UPDATE
+  """
+  save_values(Recipe, 'score', scores, batch_size=batch_size)
@@ -0,0 +1,206 @@
+# coding=utf-8
+import os
+import mmap
+import struct
+from tempfile import mkstemp
+
+import numpy as np
+
+# A segment file holds a positional index of recipe directions, in four sections:
+#   header      magic, version, number of stems, recipes and positions, and offsets of the term table and the stems
+#   postings    for every stem, the varints of the recipe id deltas, the number of positions in each recipe, and the
+#               position deltas within each recipe
+#   term table  fixed-size records, sorted by stem: offset and length of the stem, offset of its postings and number of
+#               recipes, so that a stem is found by binary search without loading anything
+#   stems       UTF-8 bytes of every stem
+MAGIC = b'RSEG'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIQQQ')
+TERM = np.dtype([('stem_offset', '<u4'), ('stem_length', '<u4'), ('postings_offset', '<u8'),
+                 ('document_frequency', '<u4')])
+
+
+def deltas(values):
+  """
+  :param values: numpy.ndarray Sorted integers
+  :return: numpy.ndarray The first integer, followed by the difference between every integer and the previous one
+  """
+  return np.concatenate((values[:1], np.diff(values)))
+
+
+def encode_varints(values):
+  """
+  Encodes non-negative integers as varints: 7 bits per byte, least significant first, with the high bit set on every
+  byte but the last of each integer.
+
+  :param values: numpy.ndarray Non-negative integers
+  :return: str Encoded bytes
+  """
+  values = np.asarray(values, dtype=np.int64)
+  if len(values) < 1:
+    return b''
+  lengths = np.ones(len(values), dtype=np.int64)
+  rest = values >> 7
+  while rest.any():
+    lengths += rest > 0
+    rest >>= 7
+
+  groups = np.arange(lengths.max())
+  encoded = (values[:, None] >> (7 * groups)) & 0x7f
+  encoded |= np.where(groups < (lengths - 1)[:, None], 0x80, 0)
+  return encoded[groups < lengths[:, None]].astype(np.uint8).tostring()
+
+
+def decode_varints(data):
+  """
+  :param data: numpy.ndarray uint8 Bytes of varints, as from encode_varints; an incomplete varint at the end is ignored
+  :return: numpy.ndarray int64 The decoded integers
+  """
+  ends = np.flatnonzero(data < 0x80)
+  if len(ends) < 1:
+    return np.zeros(0, dtype=np.int64)
+  data = data[:ends[-1] + 1]
+  starts = np.concatenate(([0], ends[:-1] + 1))
+  shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+  return np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, starts)
+
+
+def write_segment(path, index):
+  """
+  Writes a positional index to a segment file. The file is written next to the old one and renamed over it, so readers
+  never see half a segment, and processes that still map the old one keep reading it until they reopen.
+
+  :param path: str Path of the segment file
+  :param index: DirectionsPhraseIndex Index to write
+  :return: int Size of the segment file, in bytes
+  """
+  stems = sorted((stem.encode('utf-8'), term) for stem, term in index.terms.items())
+  terms = np.zeros(len(stems), dtype=TERM)
+
+  handle, temp_path = mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+  with os.fdopen(handle, 'wb') as f:
+    f.write(b'\0' * HEADER.size)
+    offset = HEADER.size
+    stem_offset = 0
+    for i, (stem, term) in enumerate(stems):
+      first, last = index.term_offsets[term], index.term_offsets[term + 1]
+      recipe_ids = index.recipe_ids[first:last].astype(np.int64)
+      position_offsets = index.position_offsets[first:last + 1]
+      positions = index.positions[position_offsets[0]:position_offsets[-1]].astype(np.int64)
+
+      # Positions are deltas from the previous position of the stem in the same recipe
+      recipe_starts = position_offsets[:-1] - position_offsets[0]
+      position_deltas = deltas(positions)
+      position_deltas[recipe_starts] = positions[recipe_starts]
+
+      data = encode_varints(np.concatenate((deltas(recipe_ids), np.diff(position_offsets), position_deltas)))
+      terms[i] = (stem_offset, len(stem), offset, len(recipe_ids))
+      f.write(data)
+      offset += len(data)
+      stem_offset += len(stem)
+
+    f.write(terms.tostring())
+    f.write(b''.join(stem for stem, term in stems))
+
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, 0, len(stems), len(np.unique(index.recipe_ids)), len(index.positions),
+                        offset, offset + terms.nbytes))
+
+  # mkstemp only lets the owner read the file; the segment gets the permissions of any other file created here
+  umask = os.umask(0)
+  os.umask(umask)
+  os.chmod(temp_path, 0o666 & ~umask)
+  os.rename(temp_path, path)
+  return os.path.getsize(path)
+
+
+class SegmentReader(object):
+  """
+  Reads a segment file through mmap, so every process serving searches shares the same copy of it in the page cache,
+  and only the postings of the stems that are searched for are ever decoded.
+  """
+
+  def __init__(self, path):
+    """
+    :param path: str Path of the segment file
+    """
+    self.path = path
+    with open(path, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, flags, term_count, recipe_count, position_count, terms_offset, stems_offset = \
+      HEADER.unpack_from(self.data, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError(u'{0} is not a version {1} segment file'.format(path, VERSION))
+    self.recipe_count = recipe_count
+    self.position_count = position_count
+    self.terms_offset = terms_offset
+    self.term_table = np.frombuffer(self.data, dtype=TERM, count=term_count, offset=terms_offset)
+    self.stems_offset = stems_offset
+
+  def __len__(self):
+    return len(self.term_table)
+
+  def stem(self, term):
+    """
+    :param term: int Term number (rank of the stem in the term table)
+    :return: str UTF-8 bytes of the stem
+    """
+    start = self.stems_offset + int(self.term_table[term]['stem_offset'])
+    return self.data[start:start + int(self.term_table[term]['stem_length'])]
+
+  def term(self, stem):
+    """
+    :param stem: unicode Stem to look up
+    :return: int Term number of the stem, or None if no recipe contains it
+    """
+    stem = stem.encode('utf-8')
+    low, high = 0, len(self.term_table)
+    while low < high:
+      middle = (low + high) // 2
+      if self.stem(middle) < stem:
+        low = middle + 1
+      else:
+        high = middle
+    return low if low < len(self.term_table) and self.stem(low) == stem else None
+
+  def decode(self, term):
+    """
+    :param term: int Term number
+    :return: tuple (numpy.ndarray sorted recipe ids, numpy.ndarray number of positions in each recipe,
+                    numpy.ndarray positions, sorted within each recipe)
+    """
+    start = int(self.term_table[term]['postings_offset'])
+    end = int(self.term_table[term + 1]['postings_offset']) if term + 1 < len(self.term_table) else self.terms_offset
+    values = decode_varints(np.frombuffer(self.data, dtype=np.uint8, count=end - start, offset=start))
+
+    document_frequency = int(self.term_table[term]['document_frequency'])
+    recipe_ids = np.cumsum(values[:document_frequency])
+    counts = values[document_frequency:2 * document_frequency]
+    positions = np.cumsum(values[2 * document_frequency:])
+    # Position deltas start over with every recipe, so the sum of the previous recipes is taken back out
+    recipe_starts = np.cumsum(counts) - counts
+    positions -= np.repeat(positions[recipe_starts] - values[2 * document_frequency:][recipe_starts], counts)
+    return recipe_ids, counts, positions
+
+  def postings(self, term):
+    """
+    :param term: int Term number
+    :return: numpy.ndarray Sorted ids of the recipes whose directions contain the stem
+    """
+    start = int(self.term_table[term]['postings_offset'])
+    document_frequency = int(self.term_table[term]['document_frequency'])
+    # Recipe id deltas come first, and a varint takes at most 10 bytes
+    values = decode_varints(np.frombuffer(self.data, dtype=np.uint8, offset=start,
+                                          count=min(10 * document_frequency, self.terms_offset - start)))
+    return np.cumsum(values[:document_frequency])
+
+  def term_keys(self, term, recipe_ids):
+    """
+    :param term: int Term number
+    :param recipe_ids: numpy.ndarray Sorted ids of recipes whose directions contain the stem
+    :return: numpy.ndarray Sorted keys (recipe id << 32 | position) of every position of the stem in those recipes
+    """
+    term_recipe_ids, counts, positions = self.decode(term)
+    keys = (np.repeat(term_recipe_ids, counts) << 32) | positions
+    return keys[np.in1d(np.repeat(term_recipe_ids, counts), recipe_ids)]
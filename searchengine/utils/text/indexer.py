@@ -0,0 +1,84 @@
+# coding=utf-8
+from django.conf import settings
+from django.db import transaction
+
+from searchengine.models import DirectionsIndex, DirectionsFulltextIndex
+from searchengine.utils.text.processor import TextProcessor
+from searchengine.utils.search.scoring import BATCH_SIZE, update_document_frequencies, forget_document_frequencies
+
+
+class DirectionsIndexer(object):
+  """
+  Writes the stems of recipe directions to DirectionsIndex and DirectionsFulltextIndex.
+
+  Rows are buffered and written with bulk_create once batch_size of them pile up, instead of one INSERT per token. The
+  document frequencies in StemFrequency are kept up to date along with them.
+  """
+
+  def __init__(self, text_processor=None, batch_size=None):
+    """
+    :param text_processor: TextProcessor Processor used to stem the directions
+    :param batch_size: int Number of buffered rows that triggers a write (defaults to settings.INDEX_BATCH_SIZE, or 1000)
+    """
+    self.text_processor = text_processor if text_processor is not None else TextProcessor()
+    self.batch_size = batch_size if batch_size is not None else getattr(settings, 'INDEX_BATCH_SIZE', 1000)
+    self.index_rows = []
+    self.fulltext_rows = []
+    self.stem_changes = {}
+
+  def add(self, recipe_id, indexed_stems):
+    """
+    Buffers the index rows of a recipe, writing out full batches as they fill up.
+
+    :param recipe_id: int Id of the recipe
+    :param indexed_stems: iterable of (stem, fulltext position, position) tuples, as from
+                          TextProcessor.iter_indexed_stems
+    """
+    stems = set()
+    for stem, fulltext_position, position in indexed_stems:
+      if position is not None:
+        self.index_rows.append(DirectionsIndex(recipe_id=recipe_id, stem=stem, position=position))
+        stems.add(stem)
+      self.fulltext_rows.append(DirectionsFulltextIndex(recipe_id=recipe_id, stem=stem, position=fulltext_position))
+
+    for stem in stems:
+      self.stem_changes[stem] = self.stem_changes.get(stem, 0) + 1
+
+    if len(self.fulltext_rows) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    """
+    Writes out every buffered row.
+    """
+    if len(self.index_rows) > 0:
+      DirectionsIndex.objects.bulk_create(self.index_rows)
+    if len(self.fulltext_rows) > 0:
+      DirectionsFulltextIndex.objects.bulk_create(self.fulltext_rows)
+    update_document_frequencies(self.stem_changes)
+    self.index_rows = []
+    self.fulltext_rows = []
+    self.stem_changes = {}
+
+  def remove_recipes(self, recipe_ids):
+    """
+    Deletes the index rows of recipes, taking them out of the document frequencies.
+
+    :param recipe_ids: list of int Ids of the recipes
+    """
+    with transaction.atomic():
+      forget_document_frequencies(recipe_ids)
+      for i in range(0, len(recipe_ids), BATCH_SIZE):
+        DirectionsIndex.objects.filter(recipe_id__in=recipe_ids[i:i + BATCH_SIZE]).delete()
+        DirectionsFulltextIndex.objects.filter(recipe_id__in=recipe_ids[i:i + BATCH_SIZE]).delete()
+
+  def index_recipes(self, recipes):
+    """
+    Indexes the directions of any number of recipes in a single transaction.
+
+    :param recipes: iterable of Recipe
+    """
+    with transaction.atomic():
+      for recipe in recipes:
+        self.add(recipe.id, self.text_processor.iter_indexed_stems(recipe.directions or u''))
+      self.flush()
@@ -0,0 +1,126 @@
+# coding=utf-8
+from time import time
+from threading import Lock
+
+from django.conf import settings
+
+from searchengine.models import Ingredient
+
+
+class IngredientMatcher(object):
+  """
+  Matches ingredient lines from recipes ('1/4 cup chopped celery root') to ingredients, entirely in memory.
+
+  Built once from the Ingredient table: every token of the ingredient search names maps to the ingredients that contain
+  it, and the tokens of every search name are kept alongside, so matching a line takes no database queries.
+  """
+
+  def __init__(self):
+    self.search_tokens = {}   # Ingredient id -> tokens of the ingredient search name
+    self.postings = {}        # Token -> ids of the ingredients whose search name contains it
+    self.built_at = None
+
+  def build(self):
+    """
+    Loads the ingredients, with a single query.
+    """
+    search_tokens = {}
+    postings = {}
+    for ingredient_id, search_name in Ingredient.objects.values_list('id', 'search_name').iterator():
+      tokens = search_name.split()
+      if len(tokens) < 1:
+        continue
+      search_tokens[ingredient_id] = tokens
+      for token in set(tokens):
+        postings.setdefault(token, []).append(ingredient_id)
+
+    self.search_tokens = search_tokens
+    self.postings = postings
+    self.built_at = time()
+    return self
+
+  def age(self):
+    return time() - self.built_at if self.built_at is not None else float('inf')
+
+  def match(self, stemmed_target_tokens):
+    """
+    Finds the ingredient whose search name most closely matches the stemmed tokens of an ingredient line.
+
+    Let's say our ingredient string is '1/4 cup chopped celery root'
+    We'll get all ingredients with '1', '4', 'cup', 'chop', 'celeri', 'root' in them after stemming
+        (Sample: 'peanut butter cup', 'chop carrot', 'chop onion', 'celeri root', 'celeri root leav', 'root veggi')
+
+    If we counted by tokens that match, we'd see the following:
+        'buttercup squash': 0
+        'chop carrot': 1
+        'chop onion': 1
+        'celeri root': 2
+        'celeri root leav': 2
+        'root veggi': 1
+
+    So obviously we need to find another heuristic than just the number of tokens from the ingredients model that
+    match the target ingredient string passed into the function. Since we don't want overly long strings that obscure
+    our fitting algorithm, we can use the % match instead as a heuristic to get the following:
+        'buttercup squash': 0.0000
+        'chop carrot': 0.5000
+        'chop onion': 0.5000
+        'celeri root': 1.0000
+        'celeri root leav': 0.6667
+        'root veggi': 0.5000
+
+    Which now gives us the desired ingredient. In the event that two or more ingredients have the same percentage
+    of matching tokens, the longest ingredient string will be chosen, as it is assumed that it will be the most
+    specific and descriptive of the target tokens. Remaining ties go to the lowest id.
+
+    :param stemmed_target_tokens: list of unicode Stemmed tokens of the ingredient line
+    :return: int/None ID of the most relevant ingredient, or None if not found
+    """
+    targets = set(stemmed_target_tokens)
+    candidates = set()
+    for token in targets:
+      candidates.update(self.postings.get(token, ()))
+
+    best_id = None
+    best_key = None
+    for ingredient_id in candidates:
+      search_tokens = self.search_tokens[ingredient_id]
+      found = len([i for i in search_tokens if i in targets])
+      key = (found / float(len(search_tokens)), len(search_tokens), -ingredient_id)
+      if best_key is None or key > best_key:
+        best_id, best_key = ingredient_id, key
+    return best_id
+
+  def match_many(self, stemmed_lines):
+    """
+    :param stemmed_lines: list of lists of unicode Stemmed tokens of each ingredient line of a recipe
+    :return: list of int/None ID of the most relevant ingredient for each line (see match)
+    """
+    return [self.match(i) for i in stemmed_lines]
+
+
+_matcher = None
+_matcher_lock = Lock()
+
+
+def get_ingredient_matcher():
+  """
+  Returns the process-wide ingredient matcher, building it on first use and rebuilding it once it is older than
+  settings.INGREDIENT_MATCHER_TTL seconds, so that new ingredients eventually get matched.
+
+  :return: IngredientMatcher
+  """
+  global _matcher
+  ttl = getattr(settings, 'INGREDIENT_MATCHER_TTL', 600)
+  with _matcher_lock:
+    if _matcher is None or _matcher.age() > ttl:
+      _matcher = IngredientMatcher().build()
+    return _matcher
+
+
+def reset_ingredient_matcher():
+  """
+  Drops the process-wide ingredient matcher so that it is rebuilt on next use.
+  """
+  global _matcher
+  with _matcher_lock:
+    _matcher = None
@@ -1,12 +1,33 @@
 # coding=utf-8
-from operator import itemgetter
+import re
+from threading import Lock
 from nltk.stem.porter import PorterStemmer
-from searchengine.models import Ingredient
+from searchengine.utils.text.matcher import get_ingredient_matcher
+
+# A token is a run of letters and digits, which may contain apostrophes (d'Asti, brewer's) and end in a % (2% milk)
+TOKEN_PATTERN = re.compile(u"[^\\W_]+(?:'[^\\W_]+)*%?", re.UNICODE)
+
+
+def to_unicode(text):
+  """
+  :param text: str/unicode Text of a document; byte strings are decoded as UTF-8
+  :return: unicode Text of the document
+  """
+  return text.decode('utf-8') if isinstance(text, str) else unicode(text)
+
 
 # We want to extend nltk.stem.porter.PorterStemmer because the bulk of it does not need to be rewritten
 # However, we do want something that can stem an entire document/string at once instead of just one document at a time
 class TextProcessor(PorterStemmer):
 
+  # Memoized stems, shared by every TextProcessor (see stem)
+  stem_cache = {}           # Words stemmed or used since the cache last filled up -> stem
+  stem_cache_previous = {}  # Words stemmed or used before that -> stem
+  stem_cache_size = 100000
+  stem_cache_hits = 0
+  stem_cache_misses = 0
+  stem_cache_lock = Lock()
+
   def __init__(self):
     super(TextProcessor, self).__init__()
     self.stopwords = (u'the', u'is', u'at', u'of', u'on', u'and', u'a')
@@ -63,17 +84,70 @@ class TextProcessor(PorterStemmer):
       u'ż': u'z'
     }
 
+    # Translation table applying char_dict to a whole document at once, along with turning both kinds of single quotes
+    # into plain apostrophes
+    self.translation_table = dict((ord(k), v) for k, v in self.char_dict.items())
+    self.translation_table.update((ord(quote), u"'") for quote in self.quotes)
+
   def stem(self, word):
     """
     Stems a word. Additional handling for edge cases in which the stemmed word ends in an apostrophe.
+
+    Stems are memoized, since the vocabulary of recipes is small and highly repetitive. The cache is shared by the
+    scraper threads and holds at most twice stem_cache_size words, approximating least recently used eviction with two
+    generations: once stem_cache_size words have been used, they become the previous generation, and those that are
+    not used again before the current generation fills up in turn are dropped.
     
     :param word: string/unicode String to be stemmed
     :return: unicode String representing the stemmed word
     """
-    word = unicode(super(TextProcessor, self).stem(word))
-    if word[-1] == u"'":
-      return word[:-1]
-    return word
+    with TextProcessor.stem_cache_lock:
+      stem = TextProcessor.stem_cache.get(word)
+      if stem is None:
+        stem = TextProcessor.stem_cache_previous.get(word)
+        if stem is not None:
+          self.cache_stem(word, stem)
+      if stem is not None:
+        TextProcessor.stem_cache_hits += 1
+        return stem
+      TextProcessor.stem_cache_misses += 1
+
+    stem = unicode(super(TextProcessor, self).stem(word))
+    if stem[-1] == u"'":
+      stem = stem[:-1]
+
+    with TextProcessor.stem_cache_lock:
+      self.cache_stem(word, stem)
+    return stem
+
+  def cache_stem(self, word, stem):
+    # Moves the word to the current generation, retiring the previous one once it's full; holds stem_cache_lock
+    if len(TextProcessor.stem_cache) >= TextProcessor.stem_cache_size:
+      TextProcessor.stem_cache_previous = TextProcessor.stem_cache
+      TextProcessor.stem_cache = {}
+    TextProcessor.stem_cache[word] = stem
+
+  def stem_many(self, words):
+    """
+    Stems a list of words, only running the stemmer once for each distinct word that hasn't been stemmed recently.
+
+    :param words: list of string/unicode Strings to be stemmed
+    :return: unicode list List of the stemmed words, in the same order
+    """
+    return [self.stem(word) for word in words]
+
+  @classmethod
+  def stem_cache_info(cls):
+    """
+    :return: dict Hits, misses and current/maximum size of the stem cache shared by every TextProcessor
+    """
+    with cls.stem_cache_lock:
+      return {
+        'hits': cls.stem_cache_hits,
+        'misses': cls.stem_cache_misses,
+        'size': len(cls.stem_cache) + len([w for w in cls.stem_cache_previous if w not in cls.stem_cache]),
+        'max_size': cls.stem_cache_size,
+      }
 
   def tokenize_text(self, data):
     """
@@ -81,10 +155,23 @@ class TextProcessor(PorterStemmer):
       
       Removes almost all punctuation, excluding apostrophes for stuff such as "Moscato d'Asti" and "brewer's yeast".
 
+      Special characters are folded with a single translate() over the whole document, and tokens are then picked out
+      with TOKEN_PATTERN. Produces the same tokens as tokenize_text_reference, which does the same thing one character
+      at a time (see test_tokenizer, and the check_tokenizer command for the stored corpus).
+
+      :param data: a string containing the text of a document (UTF-8 if it's a byte string)
+      :return: tokens: list of strings containing the processed tokens in the document
+    """
+    return TOKEN_PATTERN.findall(to_unicode(data).translate(self.translation_table))
+
+  def tokenize_text_reference(self, data):
+    """
+      Reference implementation of tokenize_text, walking the document one character at a time.
+
       :param data: a string containing the text of a document
       :return: tokens: list of strings containing the processed tokens in the document
     """
-    data = data.strip()
+    data = to_unicode(data).strip()
     tokens = []
     token = u''
     for i in range(len(data)):
@@ -134,79 +221,67 @@ class TextProcessor(PorterStemmer):
     :param remove_stopwords:  boolean Flag to remove stopword tokens from the token list 
     :return:                  unicode list List of unicode token stems in the document
     """
-    tokens = map(unicode.lower, self.tokenize_text(text))
-    if remove_stopwords:
-      tokens = [i for i in tokens if i not in self.stopwords]
-    tokens = map(self.stem, tokens)
-    return tokens
+    return list(self.iter_stems(text, remove_stopwords=remove_stopwords))
+
+  def iter_tokens(self, text):
+    """
+    Lazy version of tokenize_text.
+
+    :param text: str/unicode Text/string to be tokenized (UTF-8 if it's a byte string)
+    :return: generator of unicode tokens in the document
+    """
+    for match in TOKEN_PATTERN.finditer(to_unicode(text).translate(self.translation_table)):
+      yield match.group()
+
+  def iter_stems(self, text, remove_stopwords=False):
+    """
+    Lazy version of stem_document: tokenizes, lowercases, filters and stems one token at a time.
+
+    :param text:              str/unicode Text/string to be tokenized & stemmed
+    :param remove_stopwords:  boolean Flag to skip stopword tokens
+    :return:                  generator of unicode token stems in the document
+    """
+    for token in self.iter_tokens(text):
+      token = token.lower()
+      if remove_stopwords and token in self.stopwords:
+        continue
+      yield self.stem(token)
+
+  def iter_indexed_stems(self, text):
+    """
+    Stems a document for both the stopword-filtered and the fulltext indexes in a single tokenization pass.
+
+    :param text: str/unicode Text/string to be tokenized & stemmed
+    :return: generator of (stem, fulltext position, position) tuples for every token in the document; position is the
+             position of the token once stopwords are removed, or None if the token is a stopword
+    """
+    position = 0
+    for fulltext_position, token in enumerate(self.iter_tokens(text)):
+      token = token.lower()
+      if token in self.stopwords:
+        yield self.stem(token), fulltext_position, None
+      else:
+        yield self.stem(token), fulltext_position, position
+        position += 1
 
   def match_ingredient(self, ingredient_string):
     """
     Attempts to find the id of the ingredient whose name most closely matches the ingredient listed for a recipe.
 
+    Matching is done by the in-memory IngredientMatcher (see its match method for the heuristic), without any query.
+
     :param ingredient_string: unicode String with measurement and preparation instructions
     :return: int/None ID of the most relevant ingredient in the database, or None if not found
     """
-    if ingredient_string is None or len(ingredient_string) < 1:
-      return None
-    stemmed_target_tokens = self.stem_document(ingredient_string)
-
-    if len(stemmed_target_tokens) < 1:
-      return None
-
-    # Our version of a do-while loop
-    token = stemmed_target_tokens[0]
-    queryset = [ingredient for ingredient in Ingredient.objects.filter(search_name__icontains=token)
-                if token in ingredient.search_name.split()]
-
-    # Have to check that the target ingredient wasn't a single word so we don't get an IndexError
-    if len(stemmed_target_tokens) > 1:
-      for token in stemmed_target_tokens[1:]:
-        queryset += [ingredient for ingredient in Ingredient.objects.filter(search_name__icontains=token)
-                     if token in ingredient.search_name.split()]
-
-    # Sort by the ingredients that have the highest similarity first, then by which ingredient is the longer
-    # Let's say our ingredient string is '1/4 cup chopped celery root'
-    # We'll get all ingredients with '1', '4', 'cup', 'chop', 'celeri', 'root' in them after stemming
-    #     (Sample: 'peanut butter cup', 'chop carrot', 'chop onion', 'celeri root', 'celeri root leav', 'root veggi')
-    #
-    # If we counted by tokens that match, we'd see the following:
-    #     'buttercup squash': 0
-    #     'chop carrot': 1
-    #     'chop onion': 1
-    #     'celeri root': 2
-    #     'celeri root leav': 2
-    #     'root veggi': 1
-    #
-    # So obviously we need to find another heuristic than just the number of tokens from the ingredients model that
-    # match the target ingredient string passed into the function. Since we don't want overly long strings that obscure
-    # our fitting algorithm, we can use the % match instead as a heuristic to get the following:
-    #     'buttercup squash': 0.0000
-    #     'chop carrot': 0.5000
-    #     'chop onion': 0.5000
-    #     'celeri root': 1.0000
-    #     'celeri root leav': 0.6667
-    #     'root veggi': 0.5000
-    #
-    # Which now gives us the desired ingredient. In the event that two or more ingredients have the same percentage
-    # of matching tokens, the longest ingredient string will be chosen, as it is assumed that it will be the most
-    # specific and descriptive of the target tokens.
-
-    queryset = list(set(queryset))
-
-    search_dictionaries = []
-    for ingredient in queryset:
-      dictionary = {'id': ingredient.id}
-      stemmed_search_tokens = ingredient.search_name.split()
-      found = [i for i in stemmed_search_tokens if i in stemmed_target_tokens]
-      dictionary['name'] = ingredient.display_name
-      dictionary['search'] = ingredient.search_name
-      dictionary['similarity'] = len(found) / float(len(stemmed_search_tokens))
-      dictionary['len'] = len(stemmed_search_tokens)
-      search_dictionaries.append(dictionary)
-
-    if len(search_dictionaries) < 1:
-      return None
-
-    search_dictionaries = sorted(search_dictionaries, key=itemgetter('similarity', 'len'), reverse=True)
-    return search_dictionaries[0]['id']
+    return self.match_ingredients([ingredient_string])[0]
+
+  def match_ingredients(self, ingredient_strings, matcher=None):
+    """
+    Batch version of match_ingredient, for all the ingredient lines of a recipe at once.
+
+    :param ingredient_strings: list of unicode Strings with measurement and preparation instructions
+    :param matcher: IngredientMatcher Matcher to use, defaults to the process-wide one (see get_ingredient_matcher)
+    :return: list of int/None ID of the most relevant ingredient for each string, or None if not found
+    """
+    stemmed_lines = [self.stem_document(i) if i is not None and len(i) > 0 else [] for i in ingredient_strings]
+    return (matcher if matcher is not None else get_ingredient_matcher()).match_many(stemmed_lines)
@@ -2,13 +2,19 @@
 from math import ceil
 from time import time
 from random import randint
-from operator import itemgetter
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.template import loader
+from django.utils.http import urlquote
 
-from searchengine.models import Recipe, Ingredient
+from searchengine.models import Recipe
 from searchengine.utils.text.processor import TextProcessor
+from searchengine.utils.search.index import get_ingredient_index
+from searchengine.utils.search.phrase import get_phrase_index
+from searchengine.utils.search.query import parse_query, parse_directions_query, format_directions_query
+from searchengine.utils.search.cache import get_result_cache
+from searchengine.utils.search.cursor import encode_cursor, decode_cursor
 
 
 def index(request):
@@ -23,129 +29,114 @@ def index(request):
 def search(request):
   start_time = time()
 
-  processor = TextProcessor()
-
   querydict = request.GET
 
   # Check to make sure we have a query
   if 'q' not in querydict:
     return no_results(request)
 
-  # Get the strings to search for ingredients
-  query_ingredients = querydict['q']
-  query_ingredients = map(unicode.strip, query_ingredients.split(u','))
-  query_ingredients = [u' '.join([processor.stem(token) for token in name.split() if len(token) > 0]) for name in query_ingredients]
-  query_ingredients = map(unicode.lower, query_ingredients)
+  # Get the strings to search for ingredients, in their canonical (stemmed, de-duplicated and sorted) form
+  text_processor = TextProcessor()
+  query_ingredients, exclude_broths = parse_query(querydict['q'], text_processor)
+
+  # Optional phrases the directions have to contain (e.g. 'slow cooker'), in the same canonical form
+  directions_clauses = parse_directions_query(querydict.get('d', u''), text_processor)
+  directions_string = format_directions_query(directions_clauses)
 
   # Check to make sure the query has valid ingredient names
   if len(query_ingredients) < 1:
     return no_results(request)
 
-  # Check to see if we should be excluding broths from our query
   ingredient_string = u','.join(query_ingredients)
-  broth_types = [u'chicken', u'beef', u'pork']
-  broth_keywords = [u'broth', u'base', u'soup', u'bouillon', u'stock']
-
-  exclude_broths = len([i for i in broth_types if i in ingredient_string]) > 0
-  if exclude_broths:
-    exclude_broths = not len([i for i in broth_keywords if i in ingredient_string]) > 0
-
-  # Retrieve ingredients that contain the search names
-  ingredients = Ingredient.objects.filter(search_name__contains=query_ingredients[0])
-  for i in range(1, len(query_ingredients)):
-    ingredients |= Ingredient.objects.filter(search_name__contains=query_ingredients[i])
-  if exclude_broths:
-    for i in broth_keywords:
-      ingredients = ingredients.exclude(search_name__contains=i)
-  ingredients = ingredients.distinct().values_list('search_name', flat=True)
-
-  # Check to make sure that we have ingredients that match the search terms before moving forward
-  if ingredients.count() < 1:
-    return no_results(request)
+  query_length = len(query_ingredients)
 
-  # First pass on recipe retrieval does strict filtering
-  recipes = Recipe.objects.filter(ingredients__search_name__contains=query_ingredients[0])
-  for i in range(1, len(query_ingredients)):
-    recipes &= Recipe.objects.filter(ingredients__search_name__contains=query_ingredients[i])
-  if exclude_broths:
-    for i in broth_keywords:
-      recipes = recipes.exclude(ingredients__search_name__contains=i)
-  recipes = recipes.distinct()
-  full_match_recipes = [i for i in recipes]
-
-  # Relax the search parameters if we get < 10 recipes for our search
-  if recipes.count() < 10:
-    search_relaxed = True
-    recipes = Recipe.objects.filter(ingredients__search_name__contains=query_ingredients[0])
-    for i in range(1, len(query_ingredients)):
-      recipes |= Recipe.objects.filter(ingredients__search_name__contains=query_ingredients[i])
-    if exclude_broths:
-      for i in broth_keywords:
-        recipes = recipes.exclude(ingredients__search_name__contains=i)
-    recipes = recipes.distinct()
-    recipes = [i for i in recipes]
-  else:
-    search_relaxed = False
-    recipes = full_match_recipes
+  result_cache = get_result_cache()
+  generation = result_cache.generation()
+  ingredient_index = get_ingredient_index(generation)
 
-  if len(recipes) < 1:
+  # Every page of a search is served from the same cached ranking, which only gets extended when paging past its end
+  cache_key = u'{0!r}|{1}|{2}|{3}'.format(generation, ingredient_string, exclude_broths, directions_string)
+  results = result_cache.get(cache_key)
+  match = None
+
+  if results is None:
+    # Retrieve ingredients that contain the search names, along with the recipes that use them
+    # First pass on recipe retrieval does strict filtering, and is relaxed if we get < 10 recipes for our search
+    match = match_recipes(ingredient_index, query_ingredients, exclude_broths, directions_clauses, generation)
+
+    # Check to make sure that we have ingredients that match the search terms before moving forward
+    results = {'count': len(match.rows) if len(match.ingredient_ids) > 0 else 0, 'ranked': []}
+    if results['count'] < 1:
+      result_cache.set(cache_key, results)
+
+  recipe_count = results['count']
+  if recipe_count < 1:
     return no_results(request)
 
-  scores = {}
-  for recipe in recipes:
-    recipe_ingredients = recipe.ingredients.all().values_list('search_name', flat=True)
-    matches = [i for i in recipe_ingredients if i in ingredients]
-    scores[recipe] = recipe.score + 0.5 * len(matches) * ((len(query_ingredients) + recipe_ingredients.count()) /
-                                                          (len(query_ingredients) * recipe_ingredients.count()))
-    # Super-score/rank recipes that have all ingredients if we had to relax our search
-    if search_relaxed and recipe in full_match_recipes:
-      scores[recipe] += 10
-
-    # Score adjustments based on source
-    # BigOven composes the majority of the collection and has a good deal of low-quality results
-    # Epicurious, however, is only a small part of the collection and has high-quality results
-    if 'bigoven' in recipe.source_url:
-      scores[recipe] *= 0.9
-    elif 'epicurious' in recipe.source_url:
-      scores[recipe] *= 1.5
-
-    # Penalize recipes which have overly long ingredient lists relative to the recipe directions
-    # Significantly slows down our ranking system (increases processing time by >200%) but gives us more relevant results
-    ingredients_len = len(u' '.join([i for i in recipe_ingredients]).split())
-    directions_len = len(recipe.directions.split())
-    if directions_len < ingredients_len * 2:
-      scores[recipe] *= 0.1
-
-  scores = sorted(scores.items(), key=itemgetter(1), reverse=True)
-  recipes = [i[0] for i in scores]
-
-  # Check to see what slice of 10 results we should be returning
-  if 'pg' in querydict:
-    try:
-      pg = int(querydict['pg'])
-      pg = pg if pg >= 1 else 1
-    except ValueError:
+  # Deeper pages come with a cursor to the last result of the previous page, so they only have to rank what follows it
+  # Cursors are keyed like the cached ranking, so any process holds to them until the search results are invalidated
+  cursor = decode_cursor(querydict['cursor'], cache_key) if 'cursor' in querydict else None
+
+  if cursor is not None:
+    offset, score, recipe_id = cursor
+    pg = offset // 10 + 1
+  else:
+    # Check to see what slice of 10 results we should be returning
+    if 'pg' in querydict:
+      try:
+        pg = int(querydict['pg'])
+        pg = pg if pg >= 1 else 1
+      except ValueError:
+        pg = 1
+    else:
+      pg = 1
+
+    if (pg - 1) * 10 > recipe_count:
       pg = 1
+
+  ranked = results['ranked']
+  if len(ranked) < min(10 * pg, recipe_count):
+    if match is None:
+      match = match_recipes(ingredient_index, query_ingredients, exclude_broths, directions_clauses, generation)
+
+    if cursor is not None and len(ranked) < 10 * (pg - 1):
+      # The cached ranking doesn't reach this page (it was evicted, or built by another process), so rank the page alone
+      ranked = ingredient_index.rank(match, query_length, limit=10, after=(score, recipe_id))
+    else:
+      # Only the recipes up to the current page (or a few pages ahead) need to be ranked in order
+      depth = max(10 * pg, getattr(settings, 'SEARCH_CACHE_DEPTH', 100))
+      after = (ranked[-1][1], ranked[-1][0]) if len(ranked) > 0 else None
+      ranked = ranked + ingredient_index.rank(match, query_length, limit=depth - len(ranked), after=after)
+      result_cache.set(cache_key, {'count': recipe_count, 'ranked': ranked})
+      ranked = ranked[10 * (pg - 1):10 * pg]
   else:
-    pg = 1
+    ranked = ranked[10 * (pg - 1):10 * pg]
 
-  if (pg - 1) * 10 > len(recipes):
-    pg = 1
+  page_ids = [i[0] for i in ranked]
+  page_recipes = Recipe.objects.in_bulk(page_ids)
+
+  base_url = request.path + '?q=' + querydict['q']
+  if len(directions_clauses) > 0:
+    base_url += '&d=' + urlquote(querydict['d'])
 
   template = loader.get_template('searchengine/search.html')
   context = {
     'results': True,
     'query': querydict['q'].replace(u',', u', '),
-    'recipes': recipes[10 * (pg - 1):10 * (pg - 1) + 10],
+    'directions': querydict.get('d', u''),
+    'recipes': [page_recipes[i] for i in page_ids if i in page_recipes],
     'recipe_start': 10 * (pg - 1) + 1,
-    'recipe_count': len(recipes),
+    'recipe_count': recipe_count,
     'time': "{:.3f}".format(time() - start_time),
     'current_page': pg,
-    'base_url': request.path + '?q=' + querydict['q'],
+    'base_url': base_url,
+    'next_page': pg + 1,
   }
-  context['recipe_end'] = context['recipe_start'] + len(recipes)
+  if len(ranked) > 0 and 10 * pg < recipe_count:
+    context['next_cursor'] = encode_cursor(cache_key, 10 * pg, ranked[-1][1], ranked[-1][0])
+  context['recipe_end'] = context['recipe_start'] + recipe_count
 
-  total_pages = int(ceil(len(recipes) / 10.))
+  total_pages = int(ceil(recipe_count / 10.))
   context['only_page'] = total_pages == 1
   if total_pages >= 10:
     start_page = pg - 5 if pg - 5 >= 1 else 1
@@ -157,6 +148,12 @@ def search(request):
   return HttpResponse(template.render(context, request))
 
 
+def match_recipes(ingredient_index, query_ingredients, exclude_broths, directions_clauses, generation):
+  # Directions searches narrow down the recipes the ingredient search is run on, before it decides whether to relax
+  recipes = get_phrase_index(generation).search(directions_clauses) if len(directions_clauses) > 0 else None
+  return ingredient_index.search(query_ingredients, exclude_broths=exclude_broths, recipes=recipes)
+
+
 def no_results(request):
   empty_query = 'q' not in request.GET
 